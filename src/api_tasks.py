@@ -1,81 +1,63 @@
-import json
 import os
-from datetime import datetime, timezone
+from dataclasses import dataclass
 
-from database_utils import load_sqlite_to_chroma
+from database_utils import get_products_to_scrape, load_sqlite_to_chroma
+from fetch_daz_data import pre_fetch_daz_data
 from scraper_process import run_scraper
+from utilities import get_checkpoint, set_checkpoint
 
 
 def run_fetch_process():
-    print("Simulating external fetch process...")
-    # TODO: Replace with your actual library call.
-    return True
+    """Runs the DAZ Studio export and stages products.json in SQLite."""
+    return pre_fetch_daz_data(None)
 
 
 SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "products.db")
-CHECKPOINT_FILE = ".checkpoint"
 
 
-def get_checkpoint():
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, "r") as f:
-            return f.read().strip()
-    return "1970-01-01T00:00:00Z"
+@dataclass(slots=True)
+class TaskStatus:
+    """Progress of one background update task, polled by the status endpoint."""
 
+    status: str = "pending"
+    stage: str = "start"
+    progress: str = "Task has been queued."
 
-def set_checkpoint():
-    with open(CHECKPOINT_FILE, "w") as f:
-        f.write(datetime.now(timezone.utc).isoformat())
-    print("Checkpoint updated.")
 
-
-def run_update_flow(task_status: dict):
+def run_update_flow(task_status: TaskStatus):
     try:
-        task_status.update(
-            {
-                "status": "running",
-                "stage": "fetch",
-                "progress": "Starting external fetch...",
-            }
-        )
+        task_status.status = "running"
+        task_status.stage = "fetch"
+        task_status.progress = "Starting external fetch..."
+        # Read before the fetch, which moves the stored checkpoint forward.
+        checkpoint = get_checkpoint()
         if not run_fetch_process():
             raise RuntimeError("Fetch process failed.")
-        task_status["progress"] = "Fetch complete."
-
-        task_status["stage"] = "scrape"
-        try:
-            with open("products.json", "r") as f:
-                products = json.load(f)
-        except FileNotFoundError:
-            raise RuntimeError("products.json not found.")
+        task_status.progress = "Fetch complete."
 
-        checkpoint = get_checkpoint()
-        urls_to_scrape = [
-            p["url"]
-            for p in products
-            if p.get("date_installed", "1970-01-01T00:00:00Z") > checkpoint
-            and p.get("url")
-        ]
+        task_status.stage = "scrape"
+        # The fetch staged the catalog in SQLite, so the install-date filter
+        # runs as an indexed query.
+        products_to_scrape = get_products_to_scrape(SQLITE_DB_PATH, checkpoint)
 
-        if urls_to_scrape:
-            task_status["progress"] = (
-                f"Found {len(urls_to_scrape)} new products to scrape."
+        if products_to_scrape:
+            task_status.progress = (
+                f"Found {len(products_to_scrape)} new products to scrape."
             )
-            run_scraper(urls_to_scrape)
-        task_status["progress"] = "Scraping complete."
-
-        task_status["stage"] = "load"
-        task_status["progress"] = "Loading new data into ChromaDB..."
-        load_sqlite_to_chroma(SQLITE_DB_PATH, checkpoint)
-        set_checkpoint()
-        task_status["progress"] = "Load complete."
-
-        task_status.update(
-            {
-                "status": "complete",
-                "stage": "finished",
-                "progress": "Update process finished successfully.",
-            }
-        )
+            run_scraper(products_to_scrape)
+        task_status.progress = "Scraping complete."
+
+        task_status.stage = "load"
+        task_status.progress = "Loading new data into ChromaDB..."
+        new_checkpoint = load_sqlite_to_chroma(SQLITE_DB_PATH, checkpoint)
+        if new_checkpoint is None:
+            raise RuntimeError("Load into ChromaDB failed.")
+        set_checkpoint(new_checkpoint)
+        task_status.progress = "Load complete."
+
+        task_status.status = "complete"
+        task_status.stage = "finished"
+        task_status.progress = "Update process finished successfully."
     except Exception as e:
-        task_status.update({"status": "failed", "progress": f"An error occurred: {e}"})
+        task_status.status = "failed"
+        task_status.progress = f"An error occurred: {e}"
@@ -1,31 +1,24 @@
 # src/backfill_images.py
-import json
-import os
-import pathlib
 import sqlite3
 import sys
 
 from dotenv import load_dotenv
 
-load_dotenv()
+from database_utils import CATALOG_TABLE, create_catalog_table
 
-script_directory = pathlib.Path(__file__).parent.resolve()
-product_file = os.getenv("DAZ_PRODUCT_PATH", f"{script_directory}/products.json")
+load_dotenv()
 
 # --- Configuration ---
 # The path to your existing SQLite database.
 SQLITE_DB_PATH = "products.db"
 # The name of the table to update.
 TABLE_NAME = "product"
-# The path to your JSON file containing the SKU-to-image mapping.
-# This script assumes the file is in the project root.
-# JSON_SOURCE_FILE = "products.json"
 
 
 def backfill_image_urls():
     """
     Adds an 'image_url' column to the product table if it doesn't exist,
-    then reads a JSON file and updates the new column for each matching SKU.
+    then updates the new column from the catalog for each matching SKU.
     """
 
     # --- Step 1: Add the new column to the database ---
@@ -33,70 +26,45 @@ def backfill_image_urls():
     conn = sqlite3.connect(SQLITE_DB_PATH)
     cursor = conn.cursor()
 
-    try:
-        print("Checking for 'image_url' column and adding it if it doesn't exist...")
-        # This will safely add the column only if it's missing.
-        # It will do nothing if the column already exists.
+    print("Checking for 'image_url' column and adding it if it doesn't exist...")
+    columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({TABLE_NAME})")}
+    if "image_url" in columns:
+        print("-> 'image_url' column already exists. Skipping.")
+    else:
         cursor.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN image_url TEXT")
         print("-> 'image_url' column added successfully.")
-    except sqlite3.OperationalError as e:
-        # This error is expected if the column already exists.
-        if "duplicate column name" in str(e):
-            print("-> 'image_url' column already exists. Skipping.")
-        else:
-            # Re-raise the error if it's something else
-            raise e
 
     conn.commit()
 
-    # --- Step 2: Read the source JSON file ---
-    print(f"\nReading image URL data from: {product_file}")
-    try:
-        # We assume the JSON file is in the parent directory of 'src'
-        json_path = product_file
-        with open(json_path, "r", encoding="utf-8") as f:
-            products_data = json.load(f)
-
-        # Create a fast lookup dictionary: {sku: image_url}
-        image_url_map = {
-            item["sku"]: item["image_url"]
-            for item in products_data
-            if "sku" in item and "image_url" in item
-        }
-        print(f"Found {len(image_url_map)} products with image URLs in the JSON file.")
-
-    except FileNotFoundError:
+    # --- Step 2: Check the catalog staging table ---
+    # The DAZ export is parsed into stg_product once, by the 'fetch' command;
+    # the image URLs are copied across inside SQLite.
+    create_catalog_table(conn)
+    cursor.execute(
+        f"SELECT COUNT(*) FROM {CATALOG_TABLE} WHERE image_url IS NOT NULL"
+    )
+    staged = cursor.fetchone()[0]
+    print(f"\nFound {staged} products with image URLs in '{CATALOG_TABLE}'.")
+    if not staged:
         print(
-            f"Error: Source file not found at '{json_path}'. Please make sure it exists.",
+            f"Error: '{CATALOG_TABLE}' has no image URLs. Run the 'fetch' command first.",
             file=sys.stderr,
         )
         conn.close()
         return
-    except (json.JSONDecodeError, KeyError) as e:
-        print(
-            f"Error: Could not process '{JSON_SOURCE_FILE}'. Ensure it's a valid JSON array of objects with 'sku' and 'image_url' keys.",
-            file=sys.stderr,
-        )
-        print(f"Details: {e}", file=sys.stderr)
-        conn.close()
-        return
 
     # --- Step 3: Update the database records ---
     print("\nStarting database update process...")
-    update_count = 0
-
-    # We can update many rows efficiently with executemany
-    update_data = []
-    for sku, image_url in image_url_map.items():
-        update_data.append((image_url, sku))
-
-    if not update_data:
-        print("No data to update.")
-        conn.close()
-        return
 
-    update_sql = f"UPDATE {TABLE_NAME} SET image_url = ? WHERE sku = ?"
-    cursor.executemany(update_sql, update_data)
+    # Rows whose image_url already matches are skipped, so re-runs write nothing.
+    cursor.execute(
+        f"""UPDATE {TABLE_NAME}
+           SET image_url = {CATALOG_TABLE}.image_url
+           FROM {CATALOG_TABLE}
+           WHERE {TABLE_NAME}.sku = {CATALOG_TABLE}.sku
+             AND {CATALOG_TABLE}.image_url IS NOT NULL
+             AND {TABLE_NAME}.image_url IS NOT {CATALOG_TABLE}.image_url"""
+    )
     conn.commit()
 
     update_count = cursor.rowcount
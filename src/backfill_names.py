@@ -1,12 +1,11 @@
 # src/backfill_names.py
-import json
-import os
-import pathlib
 import sqlite3
 import sys
 
 from dotenv import load_dotenv
 
+from database_utils import CATALOG_TABLE, create_catalog_table
+
 load_dotenv()
 
 # --- Configuration ---
@@ -14,91 +13,69 @@ load_dotenv()
 SQLITE_DB_PATH = "products.db"
 # The name of the table to update.
 TABLE_NAME = "product"
-# The path to your JSON file containing the SKU-to-title mapping.
-# This script assumes the file is in the project root.
-JSON_SOURCE_FILE = "products.json"
-
-script_directory = pathlib.Path(__file__).parent.resolve()
-product_file = os.getenv("DAZ_PRODUCT_PATH", f"{script_directory}/products.json")
 
 
 def backfill_product_names():
     """
     Adds a 'name' column to the product table if it doesn't exist,
-    then reads a JSON file and updates the new column with the 'title'
-    for each matching SKU.
+    then updates the new column with the catalog 'title' for each
+    matching SKU.
     """
 
     # --- Step 1: Add the new column to the database ---
     # print(f"Connecting to database: {SQLITE_DB_PATH}")
     conn = sqlite3.connect(SQLITE_DB_PATH)
     cursor = conn.cursor()
-
-    try:
-        print("Checking for 'name' column and adding it if it doesn't exist...")
-        # This will safely add the column only if it's missing.
+    # Bulk-write tuning: WAL avoids rewriting the main file per commit, and
+    # synchronous=NORMAL drops the fsync on every transaction in WAL mode.
+    cursor.executescript(
+        "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; "
+        "PRAGMA temp_store=MEMORY; PRAGMA cache_size=-262144;"
+    )
+
+    print("Checking for 'name' column and adding it if it doesn't exist...")
+    columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({TABLE_NAME})")}
+    if "name" in columns:
+        print("-> 'name' column already exists. Skipping.")
+    else:
         cursor.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN name TEXT")
         print("-> 'name' column added successfully.")
-    except sqlite3.OperationalError as e:
-        # This error is expected if the column already exists.
-        if "duplicate column name" in str(e):
-            print("-> 'name' column already exists. Skipping.")
-        else:
-            # Re-raise the error if it's something else
-            raise e
 
     conn.commit()
 
-    # --- Step 2: Read the source JSON file ---
-    print(f"\nReading product name data from: {product_file}")
-    try:
-        # We assume the JSON file is in the parent directory of 'src'
-        json_path = product_file
-        with open(json_path, "r", encoding="utf-8") as f:
-            products_data = json.load(f)
-
-        # Create a fast lookup dictionary: {sku: title}
-        name_map = {
-            item["sku"]: item["title"]
-            for item in products_data
-            if "sku" in item and "title" in item
-        }
-        print(f"Found {len(name_map)} products with titles in the JSON file.")
-
-    except FileNotFoundError:
-        print(
-            f"Error: Source file not found at '{json_path}'. Please make sure it exists.",
-            file=sys.stderr,
-        )
-        conn.close()
-        return
-    except (json.JSONDecodeError, KeyError) as e:
+    # --- Step 2: Check the catalog staging table ---
+    # The DAZ export is parsed into stg_product once, by the 'fetch' command;
+    # the names are copied across inside SQLite.
+    create_catalog_table(conn)
+    cursor.execute(f"SELECT COUNT(*) FROM {CATALOG_TABLE} WHERE title IS NOT NULL")
+    staged = cursor.fetchone()[0]
+    print(f"\nFound {staged} products with titles in '{CATALOG_TABLE}'.")
+    if not staged:
         print(
-            f"Error: Could not process '{JSON_SOURCE_FILE}'. Ensure it's a valid JSON array of objects with 'sku' and 'title' keys.",
+            f"Error: '{CATALOG_TABLE}' is empty. Run the 'fetch' command first.",
             file=sys.stderr,
         )
-        print(f"Details: {e}", file=sys.stderr)
         conn.close()
         return
 
     # --- Step 3: Update the database records ---
     print("\nStarting database update process...")
 
-    # We can update many rows efficiently with executemany
-    update_data = []
-    for sku, name in name_map.items():
-        update_data.append((name, sku))
-
-    if not update_data:
-        print("No data to update.")
-        conn.close()
-        return
-
-    update_sql = f"UPDATE {TABLE_NAME} SET name = ? WHERE sku = ?"
-    cursor.executemany(update_sql, update_data)
+    # One set-based UPDATE ... FROM join against the staging table, inside a
+    # single write transaction. Rows whose name already matches are skipped,
+    # so re-runs do not rewrite unchanged pages into the WAL.
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute(
+        f"""UPDATE {TABLE_NAME}
+           SET name = {CATALOG_TABLE}.title
+           FROM {CATALOG_TABLE}
+           WHERE {TABLE_NAME}.sku = {CATALOG_TABLE}.sku
+             AND {CATALOG_TABLE}.title IS NOT NULL
+             AND {TABLE_NAME}.name IS NOT {CATALOG_TABLE}.title"""
+    )
+    update_count = cursor.rowcount
     conn.commit()
 
-    update_count = cursor.rowcount
     print(f"\n--- Backfill Complete ---")
     print(f"Successfully updated the 'name' for {update_count} rows in the database.")
 
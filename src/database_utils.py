@@ -1,89 +1,663 @@
 # src/database_utils.py
 
+import hashlib
 import os
+import re
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
 
-import chromadb
+import ijson
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 
 # Import the corrected embedding utility
 from embedding_utils import generate_embeddings
 
+# Load environment variables once
+load_dotenv()
 
-def _clean_metadata(item: dict) -> dict:
-    """Ensures all metadata values are of a type supported by ChromaDB."""
-    clean = {}
-    for key, value in item.items():
-        if value is not None and isinstance(value, (str, int, float, bool)):
-            clean[key] = value
-    return clean
 
+# Product columns stored as ChromaDB metadata. 'embedding_text' is left out
+# because it is already stored as the document itself.
+META_COLS = (
+    "sku",
+    "url",
+    "image_url",
+    "store",
+    "name",
+    "artist",
+    "price",
+    "description",
+    "tags",
+    "formats",
+    "poly_count",
+    "textures_info",
+    "required_products",
+    "compatible_figures",
+    "compatible_software",
+    "last_updated",
+    "category",
+    "subcategories",
+    "styles",
+    "inferred_tags",
+    "enriched_at",
+    "mature",
+)
 
-def load_sqlite_to_chroma(sqlite_db_path: str, checkpoint_date: str):
+
+def metadata_columns(cursor) -> list[str]:
+    """Returns the META_COLS that actually exist in the product table."""
+    cursor.execute("PRAGMA table_info(product)")
+    existing = {row[1] for row in cursor.fetchall()}
+    return [col for col in META_COLS if col in existing]
+
+
+# --- Cached ChromaDB Client ---
+# The PersistentClient is created once per process and reused (like `_model`
+# in embedding_utils); it keeps loaded HNSW indexes in memory. The collection
+# is looked up by name on each call, which is a cheap catalog lookup, so a
+# 'rebuild' that swaps the collection is picked up by a running server.
+_chroma_lock = threading.Lock()
+_chroma_client = None
+
+
+def chroma_collection_metadata() -> dict:
     """
-    Finds new/updated products in SQLite, generates embeddings for them,
-    and upserts them into ChromaDB.
+    Metadata for a new Chroma collection: cosine space plus HNSW index
+    parameters from the environment. Chroma applies these only when a
+    collection is created, so run 'rebuild' after changing them.
     """
-    print(
-        f"Loading products from '{sqlite_db_path}' updated after {checkpoint_date}..."
+    return {
+        "hnsw:space": "cosine",
+        "hnsw:M": int(os.getenv("CHROMA_HNSW_M", "24")),
+        "hnsw:construction_ef": int(os.getenv("CHROMA_HNSW_CONSTRUCTION_EF", "128")),
+        "hnsw:search_ef": int(os.getenv("CHROMA_HNSW_SEARCH_EF", "100")),
+        "hnsw:batch_size": int(os.getenv("CHROMA_HNSW_BATCH_SIZE", "200")),
+        "hnsw:sync_threshold": int(os.getenv("CHROMA_HNSW_SYNC_THRESHOLD", "2000")),
+    }
+
+
+def set_collection_last_update(collection, last_update: str | None):
+    """
+    Records the newest product last_updated value in the collection
+    metadata, so stats can read it without scanning every document.
+    """
+    if not last_update:
+        return
+    # Chroma rejects 'hnsw:space' in modify(); the index keeps its settings.
+    metadata = {
+        k: v for k, v in (collection.metadata or {}).items() if k != "hnsw:space"
+    }
+    metadata["last_update"] = last_update
+    try:
+        collection.modify(metadata=metadata)
+    except Exception as e:
+        print(f"Warning: Could not record last_update on the collection: {e}")
+
+
+def get_chroma_client():
+    """Returns the process-wide ChromaDB client, creating it on first use."""
+    global _chroma_client
+    with _chroma_lock:
+        if _chroma_client is None:
+            # Imported here so catalog-only commands (fetch) skip chromadb.
+            import chromadb
+
+            CHROMA_DB_PATH = os.getenv("CHROMA_PATH", "db")
+            _chroma_client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+        return _chroma_client
+
+
+def get_chroma_collection(create: bool = False):
+    """
+    Returns (client, collection) for CHROMA_COLLECTION. With `create`, a
+    missing collection is created; otherwise collection is None if it does
+    not exist.
+    """
+    from chromadb.errors import ChromaError
+
+    client = get_chroma_client()
+    COLLECTION_NAME = os.getenv("CHROMA_COLLECTION", "daz_products")
+    if create:
+        return client, client.get_or_create_collection(
+            name=COLLECTION_NAME, metadata=chroma_collection_metadata()
+        )
+    try:
+        return client, client.get_collection(name=COLLECTION_NAME)
+    except (ValueError, ChromaError):
+        # Older chromadb raises ValueError, newer a ChromaError subclass.
+        return client, None
+
+
+# Upper bound on records per Chroma upsert call; each call is one SQLite
+# transaction on Chroma's side.
+CHROMA_MAX_UPSERT = 5000
+
+
+def documents_exist(ids) -> set[str]:
+    """
+    Returns the subset of `ids` already stored in the Chroma collection,
+    using one get() per CHROMA_MAX_UPSERT ids and fetching no payloads.
+    """
+    _, collection = get_chroma_collection()
+    if collection is None:
+        return set()
+    ids = [str(i) for i in ids]
+    found = set()
+    for i in range(0, len(ids), CHROMA_MAX_UPSERT):
+        found.update(collection.get(ids=ids[i : i + CHROMA_MAX_UPSERT], include=[])["ids"])
+    return found
+
+
+def document_exists(doc_id) -> bool:
+    return str(doc_id) in documents_exist([doc_id])
+
+
+def _set_chroma_sync_mode(client, mode: str):
+    """
+    Best-effort tuning of ChromaDB's internal SQLite connection for bulk
+    writes. This reaches into private client attributes; chromadb versions
+    that do not have them are skipped silently.
+    """
+    pool = client
+    for attr in ("_server", "_sysdb", "_conn_pool"):
+        pool = getattr(pool, attr, None)
+        if pool is None:
+            return
+    if not hasattr(pool, "connect"):
+        return
+    try:
+        conn = pool.connect()
+        conn.execute(f"PRAGMA synchronous={mode}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+    except Exception as e:
+        print(f"Warning: Could not set ChromaDB SQLite synchronous={mode}: {e}")
+
+
+# --- Product catalog staging table ---
+# Mirrors the DAZ catalog from products.json (including products that have
+# not been scraped yet). products.json is parsed once, right after the DAZ
+# export, and every later step (scrape selection, backfills) reads SQLite.
+CATALOG_TABLE = "stg_product"
+
+
+def create_catalog_table(conn: sqlite3.Connection):
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS {CATALOG_TABLE} (
+            sku TEXT PRIMARY KEY,
+            title TEXT,
+            url TEXT,
+            image_url TEXT,
+            store_id INTEGER,
+            date_installed TEXT,
+            mature INTEGER,
+            categoriesData TEXT,
+            figureData TEXT
+        )"""
+    )
+    conn.execute(
+        f"CREATE INDEX IF NOT EXISTS idx_{CATALOG_TABLE}_date_installed "
+        f"ON {CATALOG_TABLE}(date_installed)"
+    )
+
+
+def _catalog_row(product: dict) -> tuple:
+    return (
+        str(product["sku"]),
+        product.get("title"),
+        product.get("url"),
+        product.get("image_url"),
+        product.get("store_id"),
+        product.get("date_installed"),
+        int(bool(product.get("mature", False))),
+        orjson.dumps(product.get("categoriesData", [])).decode(),
+        orjson.dumps(product.get("figureData", [])).decode(),
     )
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sync_product_catalog(sqlite_db_path: str, product_file: str) -> int:
+    """
+    Streams products.json into the catalog staging table with an UPSERT and
+    returns the number of products written. Raises FileNotFoundError if the
+    product file does not exist.
+
+    The file's SHA-1 is stored with the catalog; if the export is identical
+    to the one staged last time, parsing is skipped and 0 is returned.
+    """
+    digest = _file_digest(product_file)
+    conn = sqlite3.connect(sqlite_db_path)
     try:
-        conn = sqlite3.connect(sqlite_db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        create_catalog_table(conn)
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {CATALOG_TABLE}_source "
+            "(product_file TEXT PRIMARY KEY, digest TEXT)"
+        )
+        source = os.path.abspath(product_file)
+        staged = conn.execute(
+            f"SELECT digest FROM {CATALOG_TABLE}_source WHERE product_file = ?",
+            (source,),
+        ).fetchone()
+        if staged and staged[0] == digest:
+            print(f"'{product_file}' is unchanged since it was last staged.")
+            return 0
 
-        # Select rows updated or enriched after the checkpoint
-        # We also ensure embedding_text is not null.
-        cursor.execute(
-            "SELECT * FROM product WHERE (last_updated > ? OR enriched_at > ?) AND embedding_text IS NOT NULL",
-            (checkpoint_date, checkpoint_date),
+        with open(product_file, "rb") as f:
+            rows = (
+                _catalog_row(p)
+                for p in ijson.items(f, "item", use_float=True)
+                if p.get("sku")
+            )
+            # The export only carries title, store and install date; the URL,
+            # image and category fields are filled in later by 'fetch' from
+            # the store, so an existing row keeps them.
+            cursor = conn.executemany(
+                f"""INSERT INTO {CATALOG_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(sku) DO UPDATE SET
+                        title = excluded.title,
+                        url = COALESCE(excluded.url, {CATALOG_TABLE}.url),
+                        image_url = COALESCE(excluded.image_url, {CATALOG_TABLE}.image_url),
+                        store_id = excluded.store_id,
+                        date_installed = excluded.date_installed""",
+                rows,
+            )
+        count = cursor.rowcount
+        # Recorded in the same transaction as the rows it describes.
+        conn.execute(
+            f"INSERT OR REPLACE INTO {CATALOG_TABLE}_source VALUES (?, ?)",
+            (source, digest),
         )
-        products_to_load = [dict(row) for row in cursor.fetchall()]
+        conn.commit()
+        return count
+    finally:
         conn.close()
-    except sqlite3.OperationalError as e:
-        print(f"Error reading from SQLite: {e}")
+
+
+def _catalog_timestamp(value: str) -> str:
+    """
+    Returns `value` in the UTC 'YYYY-MM-DDTHH:MM:SS.mmmZ' form DAZ Studio
+    writes for date_installed, so it can be compared as a string against
+    the catalog. Values already ending in 'Z' are returned as they are.
+    """
+    if value.endswith("Z"):
+        return value
+    try:
+        ts = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc).isoformat(timespec="milliseconds").replace(
+        "+00:00", "Z"
+    )
+
+
+def get_products_to_scrape(
+    sqlite_db_path: str, installed_after: str | None = None, limit: int | None = None
+) -> list[dict]:
+    """
+    Returns the catalog products that have a store URL, in the shape the
+    spider expects. With `installed_after`, only products installed after
+    that timestamp are returned (an indexed range scan on date_installed);
+    with `limit`, at most that many rows are read.
+    """
+    conn = sqlite3.connect(sqlite_db_path)
+    try:
+        create_catalog_table(conn)
+        sql = (
+            f"SELECT sku, url, image_url, categoriesData, figureData, mature "
+            f"FROM {CATALOG_TABLE} WHERE url IS NOT NULL AND url != ''"
+        )
+        params = ()
+        if installed_after is not None:
+            # The checkpoint is normalized once so the indexed string
+            # comparison matches the catalog's timestamp format.
+            sql += " AND date_installed > ?"
+            params = (_catalog_timestamp(installed_after),)
+        if limit:
+            sql += " LIMIT ?"
+            params += (limit,)
+        return [
+            {
+                "url": url,
+                "image_url": image_url,
+                "sku": sku,
+                "categoriesData": orjson.loads(categories or "[]"),
+                "figureData": orjson.loads(figures or "[]"),
+                "mature": bool(mature),
+            }
+            for sku, url, image_url, categories, figures, mature in conn.execute(
+                sql, params
+            )
+        ]
+    finally:
+        conn.close()
+
+
+# --- sqlite-vec backend (USE_VEC=1) ---
+# Stores embeddings in a vec0 virtual table inside the products database
+# instead of ChromaDB. ChromaDB remains the default backend.
+VEC_TABLE = "vec_products"
+
+
+def use_vec_backend() -> bool:
+    return os.getenv("USE_VEC", "0") == "1"
+
+
+def use_vec_int8() -> bool:
+    """True when the vec0 table stores int8-quantized vectors (VEC_INT8=1)."""
+    return os.getenv("VEC_INT8", "0") == "1"
+
+
+def vec_param(value: str = "?") -> str:
+    """SQL expression for a vector blob (by default a bound parameter) stored in the vec0 column."""
+    return f"vec_int8({value})" if use_vec_int8() else value
+
+
+def vec_blob(vec) -> bytes:
+    """
+    Serializes one embedding for the vec0 table. For int8 storage each
+    vector is scaled by its own max-abs value onto [-127, 127]; cosine
+    distance ignores the scale, so it does not need to be stored.
+    """
+    vec = np.asarray(vec, dtype=np.float32)
+    if not use_vec_int8():
+        return vec.astype("<f4").tobytes()
+    peak = float(np.max(np.abs(vec))) or 1.0
+    return np.round(vec * (127.0 / peak)).astype(np.int8).tobytes()
+
+
+def load_sqlite_vec(conn: sqlite3.Connection):
+    """Loads the sqlite-vec extension into `conn`, unless it already is."""
+    try:
+        conn.execute("SELECT vec_version()").fetchone()
         return
+    except sqlite3.OperationalError:
+        pass
+    import sqlite_vec
+
+    conn.enable_load_extension(True)
+    sqlite_vec.load(conn)
+    conn.enable_load_extension(False)
+
 
-    if not products_to_load:
-        print("No new or updated products to load into ChromaDB.")
+def create_vec_table(conn: sqlite3.Connection, table: str = VEC_TABLE):
+    """
+    Loads the sqlite-vec extension into `conn` and ensures the vec0 table
+    exists. Raises RuntimeError if an existing table was created with a
+    different element type or size than VEC_INT8/EMBEDDING_MODEL_DIMS ask for.
+    """
+    load_sqlite_vec(conn)
+
+    dims = int(os.getenv("EMBEDDING_MODEL_DIMS", "1024"))
+    element_type = "INT8" if use_vec_int8() else "FLOAT"
+    column = f"embedding {element_type}[{dims}]"
+    declared = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    if declared is not None:
+        # CREATE ... IF NOT EXISTS would keep the old column, and every
+        # insert and query against it would then fail.
+        found = re.search(r"embedding\s+\w+\[\d+\]", declared[0])
+        if found is None or found.group(0).split() != column.split():
+            raise RuntimeError(
+                f"The sqlite-vec table '{table}' stores "
+                f"'{found.group(0) if found else declared[0]}', but the current "
+                f"VEC_INT8/EMBEDDING_MODEL_DIMS settings need '{column}'. "
+                "Run the 'rebuild' command to recreate it."
+            )
         return
+    conn.execute(
+        f"CREATE VIRTUAL TABLE {table} USING vec0("
+        f"sku TEXT PRIMARY KEY, {column} distance_metric=cosine)"
+    )
+
 
-    print(f"Found {len(products_to_load)} products to process and load.")
+def swap_vec_table(conn: sqlite3.Connection, shadow: str):
+    """
+    Replaces the vec0 table with the completed `shadow` table in a single
+    transaction, so readers see either the old vectors or the new ones.
+    """
+    # vec0 does not rename its shadow tables on ALTER TABLE ... RENAME, so
+    # the table is recreated and the vectors copied over inside SQLite.
+    conn.commit()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(f"DROP TABLE IF EXISTS {VEC_TABLE}")
+        create_vec_table(conn)
+        conn.execute(
+            f"INSERT INTO {VEC_TABLE} (sku, embedding) "
+            f"SELECT sku, {vec_param('embedding')} FROM {shadow}"
+        )
+        conn.execute(f"DROP TABLE {shadow}")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
 
-    # --- THIS IS THE CORRECTED LOGIC ---
 
-    # 1. Prepare data for embedding and for ChromaDB
-    texts_to_embed = [p["embedding_text"] for p in products_to_load]
-    ids_to_upsert = [str(p["sku"]) for p in products_to_load]
-    metadatas_to_upsert: list[dict[str, str | int | float | bool | None]] = [
-        _clean_metadata(p) for p in products_to_load
-    ]
-    documents_to_upsert = [p["embedding_text"] for p in products_to_load]
+def split_batch(rows: list, meta_cols: list[str]) -> tuple[list, list, list]:
+    """
+    Splits a batch of (sku, embedding_text, *meta) rows into the parallel
+    id/document/metadata lists, in one pass. The same lists are shared by
+    the embedding step and the vector store write.
+    """
+    ids, documents, metadatas = [], [], []
+    for sku, text, *values in rows:
+        ids.append(str(sku))
+        documents.append(text)
+        metadatas.append({k: v for k, v in zip(meta_cols, values) if v is not None})
+    return ids, documents, metadatas
 
-    # 2. Generate new embeddings ONLY for these new products
-    print(f"Generating embeddings for {len(texts_to_embed)} new/updated documents...")
-    new_embeddings = generate_embeddings(texts_to_embed, is_query=False).tolist()
-    print("Embeddings generated successfully.")
 
-    # 3. Connect to ChromaDB and upsert the complete data
-    load_dotenv()
-    CHROMA_DB_PATH = os.getenv("CHROMA_PATH", "db")
-    COLLECTION_NAME = os.getenv("CHROMA_COLLECTION", "daz_products")
-    client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-    collection = client.get_or_create_collection(
-        name=COLLECTION_NAME, metadata={"hnsw:space": "cosine"}
+def upsert_vec_batch(
+    conn: sqlite3.Connection,
+    ids: list,
+    documents: list,
+    metadatas: list,
+    embeddings,
+    table: str = VEC_TABLE,
+) -> int:
+    """Replaces the stored vectors for one batch of products."""
+    # vec0 tables do not support INSERT OR REPLACE, so delete then insert.
+    conn.executemany(f"DELETE FROM {table} WHERE sku = ?", [(i,) for i in ids])
+    conn.executemany(
+        f"INSERT INTO {table} (sku, embedding) VALUES (?, {vec_param()})",
+        ((sku, vec_blob(vec)) for sku, vec in zip(ids, embeddings)),
     )
+    conn.commit()
+    return len(ids)
+
+
+def upsert_batch(
+    collection, ids: list, documents: list, metadatas: list, embeddings
+) -> int:
+    """Upserts one batch of products with their precomputed embeddings."""
+    # Chroma takes the float32 array as-is; no per-value Python floats.
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    for i in range(0, len(ids), CHROMA_MAX_UPSERT):
+        end = i + CHROMA_MAX_UPSERT
+        collection.upsert(
+            ids=ids[i:end],
+            embeddings=embeddings[i:end],
+            metadatas=metadatas[i:end],
+            documents=documents[i:end],
+        )
+    return len(ids)
+
+
+def embed_and_write(
+    cursor: sqlite3.Cursor,
+    meta_cols: list[str],
+    batch_size: int,
+    write_batch,
+    on_error=None,
+    stop_on_error: bool = False,
+) -> tuple[int, int]:
+    """
+    Streams (sku, embedding_text, *meta) rows from `cursor` in batches,
+    embeds each batch and passes it to `write_batch(ids, documents,
+    metadatas, embeddings)`. Batch N+1 is embedded on a worker thread
+    while batch N is written, so embedding and vector store I/O overlap.
 
-    collection.upsert(
-        ids=ids_to_upsert,
-        embeddings=new_embeddings,
-        metadatas=metadatas_to_upsert,
-        documents=documents_to_upsert,
+    A batch that fails to embed or write is reported, `on_error` is called,
+    and the batch is skipped; with `stop_on_error` the exception is raised
+    instead. Returns (documents written, documents that failed).
+    """
+    upserted = 0
+    failed = 0
+
+    def write_pending(ids, documents, metadatas, future):
+        nonlocal upserted, failed
+        try:
+            upserted += write_batch(ids, documents, metadatas, future.result())
+        except Exception as e:
+            if stop_on_error:
+                raise
+            failed += len(ids)
+            if on_error is not None:
+                on_error()
+            print(f"Error: Failed to load a batch of {len(ids)} documents ({ids[0]}..{ids[-1]}): {e}")
+            return
+        print(f"--- Upserted {upserted} documents so far. ---")
+
+    pending = None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while rows := cursor.fetchmany(batch_size):
+            print(f"Generating embeddings for a batch of {len(rows)} documents...")
+            ids, documents, metadatas = split_batch(rows, meta_cols)
+            future = executor.submit(generate_embeddings, documents, is_query=False)
+            if pending is not None:
+                write_pending(*pending)
+            pending = (ids, documents, metadatas, future)
+
+        if pending is not None:
+            write_pending(*pending)
+    return upserted, failed
+
+
+def get_high_water_mark(cursor: sqlite3.Cursor) -> str | None:
+    """
+    Returns the newest last_updated/enriched_at timestamp in the product
+    table. Both columns are indexed, so each max() is a single index seek.
+    """
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_product_last_updated ON product(last_updated)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_product_enriched_at ON product(enriched_at)"
     )
+    cursor.execute(
+        "SELECT (SELECT max(last_updated) FROM product), "
+        "(SELECT max(enriched_at) FROM product)"
+    )
+    values = [v for v in cursor.fetchone() if v is not None]
+    return max(values) if values else None
+
 
+def load_sqlite_to_chroma(
+    sqlite_db_path: str, checkpoint_date: str, batch_size: int | None = None
+) -> str | None:
+    """
+    Finds new/updated products in SQLite, generates embeddings for them,
+    and upserts them into ChromaDB.
+
+    Rows are streamed from SQLite in batches of `batch_size` (defaults to
+    LOAD_BATCH_SIZE). Each batch is embedded on a worker thread while the
+    previous batch is upserted, so only two batches are ever held in memory.
+    A batch that fails is reported and skipped.
+
+    Returns the checkpoint to store for the next run: the newest timestamp
+    in the product table as of the start of the load, or `checkpoint_date`
+    unchanged if any batch failed, or None if SQLite could not be read.
+    Rows written while the load is running are newer than this value and
+    are picked up next time.
+    """
     print(
-        f"--- Successfully upserted {len(ids_to_upsert)} documents into ChromaDB. ---"
+        f"Loading products from '{sqlite_db_path}' updated after {checkpoint_date}..."
     )
+    batch_size = batch_size or int(os.getenv("LOAD_BATCH_SIZE", "1000"))
+    try:
+        conn = sqlite3.connect(sqlite_db_path)
+        cursor = conn.cursor()
+        meta_cols = metadata_columns(cursor)
+        # Taken before the load query so it never covers rows we did not load.
+        new_checkpoint = get_high_water_mark(cursor) or checkpoint_date
+        last_update = cursor.execute(
+            "SELECT max(last_updated) FROM product WHERE embedding_text IS NOT NULL"
+        ).fetchone()[0]
+        conn.commit()
+        if use_vec_backend():
+            # Set up before the row query: sqlite-vec cannot be loaded into a
+            # connection while a statement on it is still active.
+            create_vec_table(conn)
+
+        # Select rows updated or enriched after the checkpoint, projecting only
+        # the columns we store. SQLite column values are already str/int/float
+        # (or None), so no per-value type filtering is needed afterwards.
+        cursor.execute(
+            f"SELECT sku, embedding_text, {', '.join(meta_cols)} FROM product "
+            "WHERE (last_updated > ? OR enriched_at > ?) AND embedding_text IS NOT NULL",
+            (checkpoint_date, checkpoint_date),
+        )
+    except sqlite3.OperationalError as e:
+        print(f"Error reading from SQLite: {e}")
+        return None
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        conn.close()
+        return None
+
+    if use_vec_backend():
+        # sqlite-vec: vectors live next to the products in the same database,
+        # written through the same connection that is streaming the rows.
+        client = None
+        write_batch = partial(upsert_vec_batch, conn)
+        target = "sqlite-vec table 'vec_products'"
+    else:
+        client, collection = get_chroma_collection(create=True)
+        write_batch = partial(upsert_batch, collection)
+        target = "ChromaDB"
+        # Chroma's SQLite runs with synchronous=OFF for the duration of the load.
+        _set_chroma_sync_mode(client, "OFF")
+
+    # A failed batch is reported and skipped so the rest of the load goes on.
+    on_error = conn.rollback if client is None else None
+    try:
+        upserted, failed = embed_and_write(
+            cursor, meta_cols, batch_size, write_batch, on_error=on_error
+        )
+    finally:
+        if client is not None:
+            _set_chroma_sync_mode(client, "NORMAL")
+        conn.close()
+
+    if failed:
+        # Keep the old checkpoint so the failed rows are selected again next
+        # run; re-upserting the rows that did load is harmless.
+        print(f"Warning: {failed} documents could not be loaded into {target}.")
+        print(f"--- Upserted {upserted} documents; checkpoint not advanced. ---")
+        return checkpoint_date
+
+    if not upserted:
+        print(f"No new or updated products to load into {target}.")
+        return new_checkpoint
+
+    if client is not None:
+        set_collection_last_update(collection, last_update)
+    print(f"--- Successfully upserted {upserted} documents into {target}. ---")
+    return new_checkpoint
 
 
 # This function remains unchanged and correct.
@@ -1,9 +1,13 @@
 # src/embedding_utils.py
 
+import hashlib
 import os
+import sqlite3
+import threading
+import time
 
+import numpy as np
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
 
 # Load environment variables once
 load_dotenv()
@@ -24,13 +28,113 @@ def get_embedding_model():
         model_name = os.getenv(
             "EMBEDDING_MODEL_NAME", "mixedbread-ai/mxbai-embed-large-v1"
         )
-        print(f"--- Loading embedding model: {model_name} ---")
-        # You can specify the device, e.g., device='cuda', if you have a GPU
-        _model = SentenceTransformer(model_name)
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        device = os.getenv(
+            "EMBEDDING_DEVICE", "cuda" if torch.cuda.is_available() else "cpu"
+        )
+        print(f"--- Loading embedding model: {model_name} on {device} ---")
+        _model = SentenceTransformer(model_name, device=device)
+        if device.startswith("cuda"):
+            # FP16 halves VRAM and runs the matmuls on the tensor cores.
+            _model.half()
+        if os.getenv("EMBEDDING_COMPILE", "0") == "1":
+            # Fuse the transformer kernels. Compilation happens on the first
+            # forward pass, so run one warm-up encode here rather than
+            # inside the first real batch.
+            _model[0].auto_model = torch.compile(_model[0].auto_model)
+            _model.encode(["warm-up"], convert_to_tensor=False)
         print("--- Embedding model loaded. ---")
     return _model
 
 
+def _encode(texts):
+    """Runs the shared model over `texts` with the configured batch size."""
+    return get_embedding_model().encode(
+        texts,
+        batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "128")),
+        convert_to_numpy=True,
+        convert_to_tensor=False,
+    )
+
+
+# --- Persistent Embedding Cache ---
+# Vectors are keyed by SHA-256 of (model name, text) so unchanged texts are
+# never re-embedded across runs. Set EMBEDDING_CACHE_PATH="" to disable.
+# The cache is an LRU: each row records when it was last used, and once it
+# holds more than EMBEDDING_CACHE_MAX_ENTRIES rows (0 = unbounded) the least
+# recently used ones are evicted. Search queries bypass it.
+# With EMBEDDING_CACHE_FP16=1 vectors are stored as float16 (half the size)
+# under separate keys, and returned as float32 like fresh ones.
+_CACHE_LOOKUP_CHUNK = 500
+
+
+def _cache_dtype():
+    return np.float16 if os.getenv("EMBEDDING_CACHE_FP16", "0") == "1" else np.float32
+
+
+# One cache connection per thread (the loader embeds on a worker thread and
+# the API server on a thread pool), opened on first use and kept open.
+_cache_local = threading.local()
+
+
+def _open_embedding_cache():
+    """Returns this thread's embedding cache connection, or None if disabled."""
+    cache_path = os.getenv("EMBEDDING_CACHE_PATH", "embed_cache.sqlite")
+    if not cache_path:
+        return None
+    if getattr(_cache_local, "path", None) != cache_path:
+        conn = sqlite3.connect(cache_path)
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS emb "
+                "(h BLOB PRIMARY KEY, v BLOB, used REAL NOT NULL DEFAULT 0) WITHOUT ROWID"
+            )
+            # Caches written before the LRU bound have no `used` column.
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(emb)")}
+            if "used" not in columns:
+                conn.execute("ALTER TABLE emb ADD COLUMN used REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS emb_used ON emb (used)")
+        _cache_local.conn, _cache_local.path = conn, cache_path
+    return _cache_local.conn
+
+
+def _evict_lru(conn):
+    """Deletes the least recently used rows beyond EMBEDDING_CACHE_MAX_ENTRIES."""
+    max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+    if max_entries <= 0:
+        return
+    excess = conn.execute("SELECT count(*) FROM emb").fetchone()[0] - max_entries
+    if excess > 0:
+        conn.execute(
+            "DELETE FROM emb WHERE h IN (SELECT h FROM emb ORDER BY used LIMIT ?)",
+            (excess,),
+        )
+        print(f"Embedding cache: evicted {excess} least recently used entries.")
+
+
+def _cache_key(model_name: str, text: str, dtype=np.float32) -> bytes:
+    if dtype == np.float16:
+        model_name = f"{model_name}\0fp16"
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).digest()
+
+
+def _lookup_cached(conn, keys: list, dtype=np.float32) -> dict:
+    """Returns {key: vector} for every key already present in the cache."""
+    found = {}
+    unique_keys = list(dict.fromkeys(keys))
+    for i in range(0, len(unique_keys), _CACHE_LOOKUP_CHUNK):
+        chunk = unique_keys[i : i + _CACHE_LOOKUP_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT h, v FROM emb WHERE h IN ({placeholders})", chunk)
+        found.update(
+            (h, np.frombuffer(v, dtype=dtype).astype(np.float32, copy=False))
+            for h, v in rows
+        )
+    return found
+
+
 def generate_embeddings(texts, is_query: bool = False):
     """
     Generates embeddings for a given text or list of texts.
@@ -43,8 +147,6 @@ def generate_embeddings(texts, is_query: bool = False):
     Returns:
         numpy.ndarray: The embedding vector(s).
     """
-    model = get_embedding_model()
-
     # Some models, like mxbai, recommend a specific prefix for queries
     # to improve retrieval performance.
     model_name = os.getenv("EMBEDDING_MODEL_NAME", "")
@@ -61,5 +163,48 @@ def generate_embeddings(texts, is_query: bool = False):
         else:
             texts = f"Represent this sentence for searching relevant passages: {texts}"
 
-    # The .encode() method handles batching automatically for lists
-    return model.encode(texts, convert_to_tensor=False)
+    single = isinstance(texts, str)
+    batch = [texts] if single else list(texts)
+
+    # Queries are rarely repeated, so they skip the cache and its writes.
+    conn = _open_embedding_cache() if batch and not is_query else None
+    if conn is None:
+        # The .encode() method handles batching automatically for lists
+        return _encode(texts)
+
+    dtype = _cache_dtype()
+    keys = [_cache_key(model_name, text, dtype) for text in batch]
+
+    vectors = _lookup_cached(conn, keys, dtype)
+    misses = {key: text for key, text in zip(keys, batch) if key not in vectors}
+    new_vectors = {}
+    if misses:
+        print(f"Embedding cache: {len(vectors)} hits, {len(misses)} misses.")
+        encoded = _encode(list(misses.values()))
+        new_vectors = {
+            key: np.asarray(vec, dtype=np.float32)
+            for key, vec in zip(misses, encoded)
+        }
+    # The connection stays open, so commit or roll back right here.
+    now = time.time()
+    with conn:
+        if vectors:
+            conn.executemany(
+                "UPDATE emb SET used = ? WHERE h = ?",
+                ((now, key) for key in vectors),
+            )
+        if new_vectors:
+            conn.executemany(
+                "INSERT OR REPLACE INTO emb (h, v, used) VALUES (?, ?, ?)",
+                (
+                    (key, vec.astype(dtype, copy=False).tobytes(), now)
+                    for key, vec in new_vectors.items()
+                ),
+            )
+            _evict_lru(conn)
+    vectors.update(new_vectors)
+
+    # Rebuild the output in the caller's original order
+    if single:
+        return vectors[keys[0]]
+    return np.stack([vectors[key] for key in keys])
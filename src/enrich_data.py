@@ -1,19 +1,24 @@
 # src/enrich_data.py
 
+import copy
 import json
 import os
 import sqlite3
 from datetime import datetime, timezone
 from typing import List, Literal
 
+import numpy as np
 import outlines
 # --- LLM & AI Imports ---
 import torch
 from dotenv import load_dotenv
 # Pydantic is used to define our desired JSON structure
 from pydantic import BaseModel, Field
-from transformers import (AutoModelForCausalLM, AutoTokenizer,
-                          BitsAndBytesConfig)
+from transformers import (AutoConfig, AutoModelForCausalLM, AutoTokenizer,
+                          BitsAndBytesConfig, DynamicCache)
+
+from embedding_utils import generate_embeddings
+from utilities import pick_attn_implementation
 
 
 # --- 1. Define the Strict Output Schema ---
@@ -43,6 +48,100 @@ class ProductEnrichment(BaseModel):
     )
 
 
+# The prompt is a fixed instruction header followed by the per-product block.
+PROMPT_HEADER = """
+        You are an expert e-commerce cataloger for a 3D asset store.
+        Analyze the following product details and categorize it by generating a JSON object that strictly follows the provided schema.
+
+        **Product Information:**
+"""
+# Per-product block; filled with str.format_map, missing fields render empty.
+PRODUCT_BLOCK = """        - Name: {name}
+        - Existing Tags: {tags}
+        - Description: {description}"""
+# Marks where the product block goes when the chat template is pre-rendered.
+_PRODUCT_SLOT = "\x00product\x00"
+
+
+class _PromptFields(dict):
+    def __missing__(self, key):
+        return ""
+
+
+class SemanticCache:
+    """
+    Enrichment results keyed by the embedding of the product text (name,
+    tags and description). A lookup returns the stored result of the most
+    similar product if its cosine similarity reaches `threshold`. The
+    vectors and JSON payloads are persisted together in an .npz sidecar file.
+    """
+
+    # Rows added to the vector buffer each time it fills up.
+    GROW_BY = 1024
+
+    def __init__(self, path: str, threshold: float):
+        self.path = path
+        self.threshold = threshold
+        self._buffer = None
+        self.size = 0
+        self.payloads: list[str] = []
+        self.dirty = False
+        if os.path.exists(path):
+            with np.load(path) as data:
+                self._buffer = data["vectors"]
+                self.payloads = data["payloads"].tolist()
+            self.size = len(self.payloads)
+            print(f"Loaded {self.size} cached enrichments from {path}.")
+
+    @property
+    def vectors(self):
+        return None if self._buffer is None else self._buffer[: self.size]
+
+    @staticmethod
+    def normalize(vectors) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+    def lookup(self, vectors) -> list:
+        """Returns the cached JSON payload (or None) for each query vector."""
+        queries = self.normalize(vectors)
+        if not self.size:
+            return [None] * len(queries)
+        similarities = queries @ self.vectors.T
+        best = similarities.argmax(axis=1)
+        return [
+            self.payloads[j] if similarities[i, j] >= self.threshold else None
+            for i, j in enumerate(best)
+        ]
+
+    def add(self, vector, payload: str):
+        vector = self.normalize(vector)[0]
+        if self._buffer is None:
+            self._buffer = np.empty((self.GROW_BY, vector.shape[0]), dtype=np.float32)
+        elif self.size == len(self._buffer):
+            # Grow in chunks so a run of inserts does not copy the whole
+            # buffer each time.
+            self._buffer = np.concatenate(
+                [self._buffer, np.empty((self.GROW_BY, self._buffer.shape[1]), np.float32)]
+            )
+        self._buffer[self.size] = vector
+        self.size += 1
+        self.payloads.append(payload)
+        self.dirty = True
+
+    def save(self):
+        """Writes the cache to its sidecar file if anything was added."""
+        if not self.dirty:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, vectors=self.vectors, payloads=np.array(self.payloads))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        print(f"Saved {len(self.payloads)} cached enrichments to {self.path}.")
+
+
 # --- 2. Create the Local LLM Enricher Class ---
 class LocalTransformerEnricher:
     """
@@ -55,56 +154,201 @@ class LocalTransformerEnricher:
 
         # --- 4-bit Quantization Configuration ---
         # This is CRUCIAL for loading large models like Gemma 2 9B on consumer GPUs.
-        quantization_config = BitsAndBytesConfig(
-            load_in_4bit=True, bnb_4bit_compute_dtype=torch.bfloat16
-        )
-
-        print(
-            "Loading quantized model (this may take a moment and download on first run)..."
-        )
-        # Load the model with quantization and let accelerate handle device mapping
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name, quantization_config=quantization_config, device_map="auto"
-        )
+        # Pre-quantized GPTQ/AWQ checkpoints carry their own quantization_config
+        # and run fused dequant+matmul kernels, which are faster than on-the-fly
+        # bitsandbytes NF4; only plain checkpoints are quantized at load time.
+        load_kwargs = {"device_map": "auto"}
+        attn_implementation = pick_attn_implementation()
+        if attn_implementation:
+            load_kwargs["attn_implementation"] = attn_implementation
+        if getattr(AutoConfig.from_pretrained(model_name), "quantization_config", None):
+            print("Loading pre-quantized model checkpoint...")
+        else:
+            load_kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_4bit=True, bnb_4bit_compute_dtype=torch.bfloat16
+            )
+            print(
+                "Loading quantized model (this may take a moment and download on first run)..."
+            )
+        # Let accelerate handle device mapping
+        model = AutoModelForCausalLM.from_pretrained(model_name, **load_kwargs)
+        if os.getenv("LLM_COMPILE", "0") == "1":
+            # Compile the forward pass so each decode step runs fused kernels
+            # instead of eager per-op dispatch.
+            model.forward = torch.compile(model.forward, mode="reduce-overhead")
 
         self.original_tokenizer = AutoTokenizer.from_pretrained(model_name)
 
         # Create an 'outlines' adapter to control the model's output
         self.model = outlines.from_transformers(model, self.original_tokenizer)
+        # Build the JSON-schema generator (and its logits processor) once and
+        # reuse it for every product.
+        self.generator = outlines.Generator(self.model, ProductEnrichment)
+        # The schema-constrained generator stops as soon as the JSON object is
+        # closed; the cap only bounds runaway lists. A ProductEnrichment is
+        # typically well under 200 tokens.
+        self.max_new_tokens = int(os.getenv("ENRICH_MAX_NEW_TOKENS", "256"))
+
+        # Render the chat template once around a placeholder; each prompt is
+        # then a string concatenation instead of a template render.
+        messages = [{"role": "user", "content": PROMPT_HEADER + _PRODUCT_SLOT}]
+        self.prompt_prefix, self.prompt_suffix = (
+            self.original_tokenizer.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            ).split(_PRODUCT_SLOT)
+        )
+        # Optional: results for near-duplicate products are reused from this
+        # cache. It embeds every product, so it loads the embedding model
+        # next to the LLM.
+        threshold = float(os.getenv("ENRICH_CACHE_THRESHOLD", "0"))
+        self.semantic_cache = None
+        if threshold > 0:
+            cache_path = os.getenv(
+                "ENRICH_CACHE_PATH",
+                f"{os.getenv('SQLITE_DB_PATH', 'products.db')}.enrich_cache.v2.npz",
+            )
+            self.semantic_cache = SemanticCache(cache_path, threshold)
+
+        # Optional prompt cache: the KV states of the fixed prompt prefix are
+        # computed once and reused, so only the product block is prefilled.
+        self.prefix_cache = None
+        if os.getenv("ENRICH_PREFIX_CACHE", "0") == "1":
+            self.prefix_cache = self._build_prefix_cache(model)
+        if os.getenv("LLM_COMPILE", "0") == "1":
+            # Trigger compilation on a representative prompt before the
+            # product loop, so the first batch is not charged for it.
+            print("Warming up compiled model...")
+            self.generator(self._build_prompt({}), max_new_tokens=16)
         print("Transformer model loaded successfully.")
 
+    def _build_prefix_cache(self, model):
+        """
+        Runs the fixed prompt prefix through the model once and returns its
+        KV cache, or None if the prefix tokens are not a stable prefix of a
+        full prompt's tokens.
+        """
+        prefix_ids = self.original_tokenizer(
+            self.prompt_prefix, return_tensors="pt"
+        ).input_ids
+        sample_ids = self.original_tokenizer(
+            self._build_prompt({}), return_tensors="pt"
+        ).input_ids
+        # The last prefix token may merge with the product block, so it is
+        # left out of the cache and recomputed with the rest of the prompt.
+        cached_len = prefix_ids.shape[1] - 1
+        if cached_len <= 0 or not torch.equal(
+            sample_ids[0, :cached_len], prefix_ids[0, :cached_len]
+        ):
+            print("Warning: Prompt prefix does not tokenize stably; prefix cache disabled.")
+            return None
+
+        cache = DynamicCache()
+        with torch.no_grad():
+            model(
+                prefix_ids[:, :cached_len].to(model.device),
+                past_key_values=cache,
+                use_cache=True,
+            )
+        print(f"Cached KV states for {cached_len} prompt prefix tokens.")
+        return cache
+
+    def _build_prompt(self, product_info: dict) -> str:
+        """Renders the chat-templated enrichment prompt for one product."""
+        product_block = PRODUCT_BLOCK.format_map(_PromptFields(product_info))
+        return self.prompt_prefix + product_block + self.prompt_suffix
+
     def enrich(self, product_info: dict) -> ProductEnrichment:
         """Generates structured data for a single product."""
+        return self.enrich_batch([product_info])[0]
 
-        prompt = f"""
-        You are an expert e-commerce cataloger for a 3D asset store.
-        Analyze the following product details and categorize it by generating a JSON object that strictly follows the provided schema.
-
-        **Product Information:**
-        - Name: {product_info.get('name')}
-        - Existing Tags: {product_info.get('tags')}
-        - Description: {product_info.get('description')}
+    def enrich_batch(self, products: list[dict]) -> list[ProductEnrichment]:
         """
-
-        # Use the model's chat template for correct formatting
-        messages = [{"role": "user", "content": prompt}]
-        input_text = self.original_tokenizer.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
+        Generates structured data for several products. Near-duplicate
+        products are answered from the semantic cache or, within the batch,
+        from each other; the rest go through one batched generate call.
+        """
+        if self.semantic_cache is None:
+            return self._generate(products)
+
+        # Name and tags are part of the key, so products that only share
+        # vendor copy are not mistaken for duplicates.
+        texts = [
+            PRODUCT_BLOCK.format_map(_PromptFields(product)) if product.get("description") else ""
+            for product in products
+        ]
+        vectors = generate_embeddings(texts, is_query=False)
+        cached = self.semantic_cache.lookup(vectors)
+
+        misses = [i for i, payload in enumerate(cached) if payload is None or not texts[i]]
+        results = {
+            i: ProductEnrichment.model_validate_json(payload)
+            for i, payload in enumerate(cached)
+            if i not in misses
+        }
+        if results:
+            print(f"Semantic cache: {len(results)} of {len(products)} products reused.")
+
+        # Misses that duplicate an earlier miss of the same batch reuse its
+        # result instead of being generated again.
+        leaders, same_as = [], {}
+        if misses:
+            normalized = self.semantic_cache.normalize([vectors[i] for i in misses])
+            similarities = normalized @ normalized.T
+            threshold = self.semantic_cache.threshold
+            for a, i in enumerate(misses):
+                match = None
+                if texts[i]:
+                    match = next(
+                        (b for b in leaders if texts[misses[b]] and similarities[a, b] >= threshold),
+                        None,
+                    )
+                if match is None:
+                    leaders.append(a)
+                else:
+                    same_as[i] = misses[match]
+            leaders = [misses[a] for a in leaders]
+
+        if leaders:
+            generated = self._generate([products[i] for i in leaders])
+            for i, enriched_data in zip(leaders, generated):
+                results[i] = enriched_data
+                if texts[i]:
+                    self.semantic_cache.add(vectors[i], enriched_data.model_dump_json())
+        for i, leader in same_as.items():
+            results[i] = results[leader]
+        return [results[i] for i in range(len(products))]
+
+    def _generate(self, products: list[dict]) -> list[ProductEnrichment]:
+        """
+        Runs the LLM over `products` with one batched generate call;
+        outlines pads the prompts to a common length.
+        """
+        input_texts = [self._build_prompt(product) for product in products]
 
         # Use 'outlines' to force the model's output into our Pydantic schema
         # This eliminates JSON errors and ensures consistency.
-
-        structured_output = self.model(
-            input_text, ProductEnrichment, max_new_tokens=1024
-        )
-        # structured_output = utlines.generate.json(self.model, ProductEnrichment)(input_text)
-
-        print(f"{type(structured_output)} = {structured_output}")
-        # return structured_output.to_dict()
+        if len(input_texts) == 1:
+            # The prefix cache has batch size 1 and assumes no left padding,
+            # so it is only used for single prompts. generate() extends the
+            # cache in place, hence the copy.
+            kwargs = {}
+            if self.prefix_cache is not None:
+                kwargs["past_key_values"] = copy.deepcopy(self.prefix_cache)
+            outputs = [
+                self.generator(
+                    input_texts[0], max_new_tokens=self.max_new_tokens, **kwargs
+                )
+            ]
+        else:
+            outputs = self.generator.batch(
+                input_texts, max_new_tokens=self.max_new_tokens
+            )
+        return [ProductEnrichment.model_validate_json(output) for output in outputs]
 
     def close(self):
         # Transformers models loaded this way don't need an explicit close()
+        if self.semantic_cache is not None:
+            self.semantic_cache.save()
         print("LocalTransformerEnricher closing.")
 
 
@@ -114,6 +358,28 @@ SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH")
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "local")
 
 
+def _unenriched_batches(conn: sqlite3.Connection, size: int):
+    """
+    Yields lists of at most `size` products that haven't been enriched yet,
+    projecting only the fields the prompt uses. Each page is read by
+    `sku > last` after the previous batch is committed, so no read is open
+    on the enriched_at index while the updates change it.
+    """
+    query = (
+        "SELECT sku, name, tags, description FROM product "
+        "WHERE enriched_at IS NULL {after}ORDER BY sku LIMIT ?"
+    )
+    rows = conn.execute(query.format(after=""), (size,)).fetchall()
+    while rows:
+        yield [
+            {"sku": sku, "name": name, "tags": tags, "description": description}
+            for sku, name, tags, description in rows
+        ]
+        rows = conn.execute(
+            query.format(after="AND sku > ? "), (rows[-1][0], size)
+        ).fetchall()
+
+
 def main(args):
     """Main loop to connect to the DB and process unenriched products."""
 
@@ -130,41 +396,47 @@ def main(args):
             )
 
         conn = sqlite3.connect(SQLITE_DB_PATH)
-        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
+        # WAL + synchronous=NORMAL: each batch commit appends to the WAL
+        # without an fsync; busy_timeout lets the scraper/loader share the DB.
+        cursor.executescript(
+            "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; "
+            "PRAGMA busy_timeout=5000; PRAGMA temp_store=MEMORY;"
+        )
 
-        # Select products that haven't been enriched yet
-        cursor.execute("SELECT * FROM product WHERE enriched_at IS NULL")
-        products_to_process = cursor.fetchall()
-
-        print(f"\nFound {len(products_to_process)} products to enrich.")
+        cursor.execute("SELECT COUNT(*) FROM product WHERE enriched_at IS NULL")
+        print(f"\nFound {cursor.fetchone()[0]} products to enrich.")
 
-        for row in products_to_process:
-            product = dict(row)
-            sku = product.get("sku")
-            print(f"--- Processing SKU: {sku} ({product.get('name')}) ---")
+        batch_size = int(os.getenv("ENRICH_BATCH_SIZE", "16"))
+        for batch in _unenriched_batches(conn, batch_size):
+            skus = [product["sku"] for product in batch]
+            print(f"--- Processing {len(batch)} SKUs: {', '.join(map(str, skus))} ---")
 
             try:
-                enriched_data = enricher.enrich(product)
+                enriched = enricher.enrich_batch(batch)
 
                 # Update the database with the new structured data
-                cursor.execute(
+                enriched_at = datetime.now(timezone.utc).isoformat()
+                cursor.executemany(
                     """UPDATE product
                        SET category = ?, subcategories = ?, styles = ?, inferred_tags = ?, enriched_at = ?
                        WHERE sku = ?""",
-                    (
-                        enriched_data.category,
-                        json.dumps(enriched_data.subcategories),
-                        json.dumps(enriched_data.styles),
-                        json.dumps(enriched_data.inferred_tags),
-                        datetime.now(timezone.utc).isoformat(),
-                        sku,
-                    ),
+                    [
+                        (
+                            enriched_data.category,
+                            json.dumps(enriched_data.subcategories),
+                            json.dumps(enriched_data.styles),
+                            json.dumps(enriched_data.inferred_tags),
+                            enriched_at,
+                            sku,
+                        )
+                        for sku, enriched_data in zip(skus, enriched)
+                    ],
                 )
                 conn.commit()
-                print(f"-> Success: Enriched and updated SKU {sku}.")
+                print(f"-> Success: Enriched and updated {len(batch)} SKUs.")
             except Exception as e:
-                print(f"-> ERROR processing SKU {sku}: {e}")
+                print(f"-> ERROR processing SKUs {', '.join(map(str, skus))}: {e}")
 
         conn.close()
         print("\nEnrichment process complete.")
@@ -1,16 +1,23 @@
-import json
+import asyncio
 import os
 import pathlib
-from utilities import fetch_json_from_url, run_daz_script, get_checkpoint, set_checkpoint
+import sqlite3
+import sys
+
+import aiohttp
+import orjson
+from utilities import run_daz_script, get_checkpoint, set_checkpoint
+from database_utils import CATALOG_TABLE, create_catalog_table, sync_product_catalog
 from dotenv import load_dotenv
 
 load_dotenv()
 
 script_directory = pathlib.Path(__file__).parent.resolve()
 product_file = os.getenv("DAZ_PRODUCT_PATH", f"{script_directory}/products.json")
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "products.db")
 
 
-def pre_fetch_faz_data(args):
+def pre_fetch_daz_data(args):
 
     script_name = "ListProductsMetadataSA.dsa"
     script_args = [product_file, get_checkpoint()]
@@ -23,48 +30,125 @@ def pre_fetch_faz_data(args):
             print(f"Error: Expected output file '{product_file}' not found.")
             return False
         print(f"Wrote product metadata to {product_file}")
+        # Parse the export once into the catalog staging table; later steps
+        # read the catalog from SQLite.
+        count = sync_product_catalog(SQLITE_DB_PATH, product_file)
+        print(f"Staged {count} products in '{CATALOG_TABLE}'.")
         set_checkpoint()
     return True
 
+async def _fetch_slab(session, semaphore, sku: str, timeout: int = 10) -> dict | None:
+    """Fetches the DAZ store 'slab' JSON for one SKU, or None on any error."""
+    slab_url = f"http://www.daz3d.com/dazApi/slab/{sku}"
+    async with semaphore:
+        try:
+            async with session.get(
+                slab_url, timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                response.raise_for_status()
+                return await response.json(loads=orjson.loads, content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+            print(f"Error: Could not fetch {slab_url}: {e}", file=sys.stderr)
+            return None
+
+
+def _slab_row(sku: str, content: dict) -> tuple:
+    """Builds the stg_product row for one SKU from its slab JSON."""
+    # imageUrl wraps the CDN URL in a resizing proxy; keep the CDN part.
+    _, cdn_prefix, cdn_path = content["imageUrl"].rpartition("https://gcdn")
+    image_url = cdn_prefix + cdn_path
+    product_url = f"https://www.daz3d.com/{content['url']}"
+    # Extract categoriesData and figureData if available
+    return (
+        sku,
+        product_url,
+        image_url,
+        int(bool(content.get("mature", False))),
+        orjson.dumps(content.get("categoriesData", [])).decode(),
+        orjson.dumps(content.get("figureData", [])).decode(),
+    )
+
+
+async def _resolve_store_urls(conn, daz_products: list, concurrency: int) -> int:
+    """
+    Fetches slab data for the SKUs in `daz_products` with at most
+    `concurrency` requests in flight, upserting and committing each chunk of
+    results as it lands so an interrupted run keeps its progress. Returns
+    the number of rows saved.
+    """
+    chunk_size = concurrency * 10
+    saved = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for i in range(0, len(daz_products), chunk_size):
+            chunk = daz_products[i : i + chunk_size]
+            contents = await asyncio.gather(
+                *(_fetch_slab(session, semaphore, sku) for sku in chunk)
+            )
+            rows = [
+                _slab_row(sku, content)
+                for sku, content in zip(chunk, contents)
+                if content is not None
+            ]
+            conn.executemany(
+                f"""INSERT INTO {CATALOG_TABLE}
+                        (sku, url, image_url, mature, categoriesData, figureData)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(sku) DO UPDATE SET
+                        url = excluded.url,
+                        image_url = excluded.image_url,
+                        mature = excluded.mature,
+                        categoriesData = excluded.categoriesData,
+                        figureData = excluded.figureData""",
+                rows,
+            )
+            conn.commit()
+            saved += len(rows)
+            print(
+                f"--- Processed {i + len(chunk)} of {len(daz_products)} "
+                f"({len(rows)} of {len(chunk)} resolved) ---"
+            )
+    return saved
+
+
 def fetch_daz_data(args):
     # https://www.daz3d.com/cdn-cgi/image/width=380,height=494,fit=cover/https://gcdn.daz3d.com/p/90233/i/dforcefantasyholooutfitforgenesis9and8females00thumbdaz3d.jpg
     # If we got valid data, read it and get the correct product url for each product
 
-    print(f"+++++++++++++++++ TEST {product_file}")
-    product_data = json.load(open(product_file, "r"))
-    print(f"Fetched {len(product_data)} products from DAZ Studio.")
-
-    x = 0
-    for product in product_data:
-        if "url" not in product or not product["url"]:
-            if product["store_id"] == 1:  # DAZ Store
-                sku = product.get("sku")
-                slab_url = f"http://www.daz3d.com/dazApi/slab/{sku}"
-                content = fetch_json_from_url(slab_url)
-                print(f"+++++ Process Item {x} of {len(product_data)}")
-                if content is not None:
-                    image_root_url = content["imageUrl"]
-                    image_url = image_root_url[
-                        image_root_url.rfind("https://gcdn") :
-                    ]
-
-                    product_url = f"https://www.daz3d.com/{content['url']}"
-                    product["url"] = product_url
-                    product["image_url"] = image_url
-                    product["mature"] = content.get("mature", False)
-                    product["categoriesData"] = content.get("categoriesData", [])
-                    product["figureData"] = content.get("figureData", [])
-                    # Extract categoriesData and figureData if available
-                    print(
-                        f"Info: Computed DAZ Store URL for '{product['title']}' as '{product['url']}' with image_url '{image_url}'."
-                    )
-            else:
-                print(
-                    f"Warning: No URL computable for '{product['title']}' (Store ID: {product['store_id']})."
-                )
-        x += 1
-    with open(product_file, "w") as f:
-        json.dump(product_data, f, indent=2)        
+    conn = sqlite3.connect(SQLITE_DB_PATH)
+    create_catalog_table(conn)
+    # Only DAZ Store products (store_id 1) have a computable store URL.
+    pending = f"FROM {CATALOG_TABLE} WHERE (url IS NULL OR url = '')"
+    # Products that were already scraped have their URL in the product
+    # table; skip them with one anti-join instead of a lookup per SKU.
+    if conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product'"
+    ).fetchone():
+        pending += (
+            f" AND NOT EXISTS (SELECT 1 FROM product WHERE product.sku = {CATALOG_TABLE}.sku"
+            " AND product.url IS NOT NULL AND product.url != '')"
+        )
+    daz_products = [
+        sku for (sku,) in conn.execute(f"SELECT sku {pending} AND store_id = 1")
+    ]
+    other_stores = conn.execute(
+        f"SELECT COUNT(*) {pending} AND store_id IS NOT 1"
+    ).fetchone()[0]
+    print(f"Found {len(daz_products) + other_stores} catalog products without a store URL.")
+    if other_stores:
+        print(
+            f"Warning: No URL computable for {other_stores} products from other stores."
+        )
+
+    # The slab lookups are network-bound, so they run concurrently.
+    concurrency = int(os.getenv("DAZ_FETCH_CONCURRENCY", "20"))
+    print(f"Fetching store data for {len(daz_products)} DAZ products ({concurrency} at a time)...")
+    try:
+        saved = asyncio.run(_resolve_store_urls(conn, daz_products, concurrency))
+    finally:
+        conn.close()
+    print(f"Saved store URLs for {saved} products.")
     return True
 
 if __name__ == "__main__":
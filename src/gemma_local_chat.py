@@ -4,6 +4,8 @@ from typing import Dict, List, Optional
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
 
+from utilities import pick_attn_implementation
+
 
 class GemmaLocalChat:
     """
@@ -17,6 +19,8 @@ class GemmaLocalChat:
         torch_dtype: torch.dtype = torch.float16,
         trust_remote_code: bool = True,
         max_memory: Optional[Dict] = None,
+        attn_implementation: Optional[str] = None,
+        compile_model: bool = False,
     ):
         """
         Initialize the Gemma chat model.
@@ -27,6 +31,9 @@ class GemmaLocalChat:
             torch_dtype: Data type for model weights
             trust_remote_code: Whether to trust remote code
             max_memory: Memory constraints for model loading
+            attn_implementation: Attention kernel ('flash_attention_2', 'sdpa',
+                'eager'); defaults to FlashAttention-2 when available
+            compile_model: Whether to torch.compile the forward pass
         """
         self.model_name = model_name
         self.device = self._setup_device(device)
@@ -39,6 +46,10 @@ class GemmaLocalChat:
         # Chat history
         self.chat_history: List[Dict[str, str]] = []
 
+        # KV cache of the conversation so far and the token ids it covers
+        self._past_kv = None
+        self._cached_ids: List[int] = []
+
         # Default generation config
         self.generation_config = GenerationConfig(
             max_new_tokens=512,
@@ -50,7 +61,9 @@ class GemmaLocalChat:
         )
 
         # Load model and tokenizer
-        self._load_model(trust_remote_code, max_memory)
+        self._load_model(trust_remote_code, max_memory, attn_implementation)
+        if compile_model:
+            self._compile_model()
 
     def _setup_device(self, device: str) -> torch.device:
         """Setup the appropriate device for model inference."""
@@ -61,7 +74,12 @@ class GemmaLocalChat:
                 return torch.device("cpu")
         return torch.device(device)
 
-    def _load_model(self, trust_remote_code: bool, max_memory: Optional[Dict]):
+    def _load_model(
+        self,
+        trust_remote_code: bool,
+        max_memory: Optional[Dict],
+        attn_implementation: Optional[str] = None,
+    ):
         """Load the tokenizer and model."""
         try:
             print(f"Loading tokenizer from {self.model_name}...")
@@ -83,6 +101,10 @@ class GemmaLocalChat:
             if max_memory:
                 model_kwargs["max_memory"] = max_memory
 
+            attn_implementation = attn_implementation or pick_attn_implementation()
+            if attn_implementation:
+                model_kwargs["attn_implementation"] = attn_implementation
+
             self.model = AutoModelForCausalLM.from_pretrained(
                 self.model_name, **model_kwargs
             )
@@ -100,33 +122,45 @@ class GemmaLocalChat:
             logging.error(f"Error loading model: {e}")
             raise
 
-    def _format_chat_prompt(
-        self, user_message: str, include_history: bool = True
-    ) -> str:
+    def _compile_model(self):
+        """Compile the forward pass and run one short warm-up generation."""
+        print("Compiling model forward pass...")
+        self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead")
+        # Same chat-template path as chat(), so the warm-up compiles the
+        # graph real prompts use.
+        inputs = self._build_chat_inputs("Hello", include_history=False)
+        with torch.no_grad():
+            self.model.generate(
+                **inputs,
+                max_new_tokens=8,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        print("Model compiled.")
+
+    def _build_chat_inputs(self, user_message: str, include_history: bool = True):
         """
-        Format the chat prompt for Gemma using the instruction format.
+        Tokenize the conversation with the model's own chat template.
 
         Args:
             user_message: The user's input message
             include_history: Whether to include chat history in the prompt
 
         Returns:
-            Formatted prompt string
+            Dict with input_ids and attention_mask tensors on the model device
         """
-        if include_history and self.chat_history:
-            # Build conversation context
-            conversation = ""
+        messages = []
+        if include_history:
             for turn in self.chat_history[-5:]:  # Keep last 5 turns for context
-                conversation += (
-                    f"User: {turn['user']}\nAssistant: {turn['assistant']}\n\n"
-                )
-
-            prompt = f"{conversation}User: {user_message}\nAssistant:"
-        else:
-            # Simple single-turn format
-            prompt = f"User: {user_message}\nAssistant:"
-
-        return prompt
+                messages.append({"role": "user", "content": turn["user"]})
+                messages.append({"role": "assistant", "content": turn["assistant"]})
+        messages.append({"role": "user", "content": user_message})
+
+        return self.tokenizer.apply_chat_template(
+            messages,
+            add_generation_prompt=True,
+            return_tensors="pt",
+            return_dict=True,
+        ).to(self.device)
 
     def chat(
         self,
@@ -156,13 +190,8 @@ class GemmaLocalChat:
                 "Model not loaded. Please initialize the class properly."
             )
 
-        # Format the prompt
-        prompt = self._format_chat_prompt(message, include_history)
-
-        # Tokenize input
-        inputs = self.tokenizer(
-            prompt, return_tensors="pt", padding=True, truncation=True, max_length=2048
-        ).to(self.device)
+        # Format and tokenize the prompt in one step
+        inputs = self._build_chat_inputs(message, include_history)
 
         # Update generation config
         gen_config = GenerationConfig(
@@ -174,32 +203,65 @@ class GemmaLocalChat:
             eos_token_id=self.tokenizer.eos_token_id,
         )
 
-        # Generate response
+        # Generate response; the KV cache of the previous turns is reused so
+        # only tokens that are new since the last call are prefilled.
+        generate_kwargs = {}
+        past_kv = self._reusable_cache(inputs.input_ids)
+        if past_kv is not None:
+            generate_kwargs["past_key_values"] = past_kv
         with torch.no_grad():
             outputs = self.model.generate(
                 input_ids=inputs.input_ids,
                 attention_mask=inputs.attention_mask,
                 generation_config=gen_config,
                 use_cache=True,
+                return_dict_in_generate=True,
+                **generate_kwargs,
             )
+        self._past_kv = outputs.past_key_values
+        self._cached_ids = outputs.sequences[0][
+            : self._past_kv.get_seq_length()
+        ].tolist()
 
         # Decode response (only the new tokens)
-        new_tokens = outputs[0][inputs.input_ids.shape[1] :]
+        new_tokens = outputs.sequences[0][inputs.input_ids.shape[1] :]
         response = self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
 
-        # Clean up response (remove any remaining prompt artifacts)
-        if response.startswith("Assistant:"):
-            response = response[10:].strip()
-
         # Save to history if requested
         if save_to_history:
             self.chat_history.append({"user": message, "assistant": response})
 
         return response
 
+    def _reusable_cache(self, input_ids):
+        """
+        Return the cached KV states trimmed to the longest prefix they share
+        with `input_ids`, or None if nothing can be reused. At least one
+        input token is always left for the model to process.
+        """
+        if self._past_kv is None or not hasattr(self._past_kv, "crop"):
+            return None
+        common = 0
+        for cached, new in zip(self._cached_ids, input_ids[0].tolist()):
+            if cached != new:
+                break
+            common += 1
+        common = min(common, input_ids.shape[1] - 1)
+        if common == 0:
+            self._reset_cache()
+            return None
+        self._past_kv.crop(common)
+        return self._past_kv
+
+    def _reset_cache(self):
+        """Drop the cached KV states of the conversation."""
+        self._past_kv = None
+        self._cached_ids = []
+
     def clear_history(self):
         """Clear the chat history."""
         self.chat_history.clear()
+        self._reset_cache()
         print("Chat history cleared.")
 
     def get_history(self) -> List[Dict[str, str]]:
@@ -232,6 +294,7 @@ class GemmaLocalChat:
         try:
             with open(filename, "r", encoding="utf-8") as f:
                 self.chat_history = json.load(f)
+            self._reset_cache()
             print(f"Conversation loaded from {filename}")
         except Exception as e:
             print(f"Error loading conversation: {e}")
@@ -1,6 +1,7 @@
 # src/inspect_chroma.py
 
 import os
+import sys
 
 import chromadb
 from dotenv import load_dotenv
@@ -41,25 +42,20 @@ def inspect_collection_metadata(limit: int = 5):
         return
 
     # --- Iterate and print the metadata and its type ---
+    # Each item is formatted as one block and written with a single call.
     for i, item_id in enumerate(results["ids"]):
         metadata = results["metadatas"][i]
 
-        print("\n" + "=" * 50)
-        print(f"INSPECTING ITEM ID: {item_id}")
-        print("=" * 50)
-
+        lines = ["", "=" * 50, f"INSPECTING ITEM ID: {item_id}", "=" * 50]
         for key, value in metadata.items():
-            # Get the Python type of the value
-            value_type = type(value).__name__
-
-            # Print the key, its type, and a sample of the value
-            print(f"  - Key: '{key}'")
-            print(f"    Type: {value_type}")
             # Truncate long values for readability
             value_sample = str(value)
             if len(value_sample) > 100:
                 value_sample = value_sample[:100] + "..."
-            print(f"    Value: {value_sample}")
+            lines.append(
+                f"  - Key: '{key}'\n    Type: {type(value).__name__}\n    Value: {value_sample}"
+            )
+        sys.stdout.write("\n".join(lines) + "\n")
 
     print("\n--- Inspection Complete ---")
 
@@ -1,23 +1,15 @@
+# PYTHON_ARGCOMPLETE_OK
 import argparse
-import json
 import os
 import re
-from datetime import datetime, timedelta, timezone
-from output_formatters import print_pretty, print_json, print_table
+import sys
 from collections import Counter
-import uvicorn
-from dotenv import load_dotenv
 
-from utilities import get_checkpoint, set_checkpoint
-from database_utils import load_sqlite_to_chroma
-#from enrich_data import main as run_enrichment
-from fetch_daz_data import pre_fetch_faz_data, fetch_daz_data
-from fetch_daz_data import product_file
-from query_utils import get_db_stats, search
-from rebuild_chroma import main as run_rebuild
-from scraper_process import run_scraper
+# Command dependencies (ChromaDB, torch, Scrapy, uvicorn, ...) are imported
+# inside the command that needs them, so the CLI starts quickly.
 
-load_dotenv()
+
+_WHITESPACE_RE = re.compile(r"\s+")
 
 
 def slugify_regex(text: str) -> str:
@@ -34,15 +26,20 @@ def slugify_regex(text: str) -> str:
     # 1. Convert to lowercase
     lower_text = text.lower()
 
-    # 2. Replace one or more whitespace characters (\s+) with a single dash
-    slug = re.sub(r"\s+", "-", lower_text)
+    # 2. ASCII text: str.split() collapses whitespace runs in C, no regex needed
+    if lower_text.isascii():
+        return "-".join(lower_text.split()).strip("-")
+
+    # 3. Otherwise replace one or more whitespace characters (\s+) with a
+    #    single dash and remove leading/trailing dashes
+    return _WHITESPACE_RE.sub("-", lower_text).strip("-")
 
-    # 3. (Optional) Remove leading/trailing dashes that might be created
-    return slug.strip("-")
 
 def fetch_command(args):
     print("Starting fetch command...")
-    rv = pre_fetch_faz_data(args)
+    from fetch_daz_data import pre_fetch_daz_data
+
+    rv = pre_fetch_daz_data(args)
     # if rv and args.prefetch_only == False:
     #     rv = fetch_daz_data(args)
     print("Fetch command complete.")
@@ -51,55 +48,30 @@ def fetch_command(args):
 
 def scrape_command(args):
     print("Starting scrape command...")
-    dbfile = product_file
-
-    try:
-        with open(dbfile, "r") as f:
-            products = json.load(f)
-            print(f"Loaded {len(products)} products from {dbfile}.")
-    except FileNotFoundError:
-        print("Error: products.json not found. Run the 'fetch' command first.")
-        return
-
-    # --- THIS IS THE KEY CHANGE ---
-    # We now build a list of dictionaries, not just URLs.
-    products_to_scrape = []
+    from database_utils import get_products_to_scrape
+    from scraper_process import run_scraper
+    from utilities import get_checkpoint
+
+    sqlite_db_path = os.getenv("SQLITE_DB_PATH", "products.db")
+    # The limit is applied in the query, so only the rows that will be
+    # scraped are read and decoded.
+    limit = args.limit if args.limit and args.limit > 0 else None
+    if limit:
+        print(f"Applying limit: processing at most {limit} products.")
+
+    # The catalog was staged in SQLite by the 'fetch' command, so products
+    # are selected with a query instead of re-parsing products.json.
     if args.update:
         checkpoint = get_checkpoint()
         print(f"Update mode enabled. Scraping products installed after {checkpoint}.")
-        for product in products:
-            if product.get("date_installed", "1970-01-01T00:00:00Z") > checkpoint:
-                if product.get("url") and product.get("sku"):
-                    products_to_scrape.append(
-                        {
-                            "url": product["url"],
-                            "image_url": product["image_url"],
-                            "sku": product["sku"],
-                            "categoriesData": product.get("categoriesData", []),
-                            "figureData": product.get("figureData", []),
-                            "mature": product.get("mature", False),
-                        }
-                    )
+        products_to_scrape = get_products_to_scrape(sqlite_db_path, checkpoint, limit=limit)
     else:
-        print("Update mode off. Scraping all products from products.json.")
-        products_to_scrape = [
-            {
-                "url": p["url"],
-                "image_url": p["image_url"],
-                "sku": p["sku"],
-                "categoriesData": p.get("categoriesData", []),
-                "figureData": p.get("figureData", []),
-                "mature": p.get("mature", False),
-            }
-            for p in products
-            if p.get("url") and p.get("sku")
-        ]
-
-    if args.limit and args.limit > 0:
-        print(
-            f"Applying limit: processing only the first {args.limit} of {len(products_to_scrape)} products."
-        )
-        products_to_scrape = products_to_scrape[: args.limit]
+        print("Update mode off. Scraping all products in the catalog.")
+        products_to_scrape = get_products_to_scrape(sqlite_db_path, limit=limit)
+
+    if not products_to_scrape and not args.update:
+        print("Error: No products in the catalog. Run the 'fetch' command first.")
+        return
 
     if products_to_scrape:
         # Pass the entire list of product dicts
@@ -116,36 +88,63 @@ def enrich_command(args):
 
 def rebuild_command(args):
     """
-    Performs a full, destructive rebuild of the ChromaDB collection
-    from the SQLite database.
+    Performs a full rebuild of the ChromaDB collection (or, with USE_VEC=1,
+    the sqlite-vec table) from the SQLite database. The existing vectors are
+    replaced only once the new ones are complete.
     """
 
     # Add a confirmation prompt to prevent accidental data loss
-    confirm = input(
-        "WARNING: This will delete and rebuild the entire ChromaDB collection. "
-        "This can take a long time. Are you sure you want to continue? (yes/no): "
-    )
+    if args.yes:
+        confirm = "yes"
+    else:
+        confirm = input(
+            "WARNING: This will replace the entire vector store. "
+            "This can take a long time. Are you sure you want to continue? (yes/no): "
+        )
     if confirm.lower() == "yes":
-        print("Starting full ChromaDB rebuild...")
-        run_rebuild()
+        print("Starting full vector store rebuild...")
+        from rebuild_chroma import main as run_rebuild
+
+        run_rebuild(batch_size=args.batch_size)
     else:
         print("Rebuild cancelled.")
 
 
 def load_command(args):
     print("Starting load command...")
+    from database_utils import load_sqlite_to_chroma
+    from utilities import get_checkpoint, set_checkpoint
+
     checkpoint = get_checkpoint()
-    load_sqlite_to_chroma(checkpoint) # type: ignore
-    set_checkpoint()
+    new_checkpoint = load_sqlite_to_chroma(
+        os.getenv("SQLITE_DB_PATH", "products.db"),
+        checkpoint,
+        batch_size=args.batch_size,
+    )
+    if new_checkpoint is None:
+        print("Error: Load failed; checkpoint not updated.")
+        return
+    set_checkpoint(new_checkpoint)
 
 
 def query_command(args):
     """Submits a query to the ChromaDB and prints the formatted results."""
     print("Starting query command...")
+    from output_formatters import print_json, print_pretty, print_table
+    from query_utils import search_batch
 
-    # The search function returns a dictionary with 'total_hits', 'results', etc.
-    response = search(
-        prompt=args.prompt,
+    if args.prompts_file:
+        prompts = [line.strip() for line in args.prompts_file if line.strip()]
+    elif args.prompt:
+        prompts = [args.prompt]
+    else:
+        print("Error: Provide a prompt or --prompts-file.")
+        return
+
+    # All prompts are embedded and sent to the vector store in one batch.
+    # Each response is a dictionary with 'total_hits', 'results', etc.
+    responses = search_batch(
+        prompts,
         tags=args.tags,
         limit=args.limit,
         score_threshold=args.score,
@@ -153,47 +152,67 @@ def query_command(args):
         sort_order=args.sort_order,
     )
 
-    if not response or not response.get("results"):
-        print("\n--- No results found for your query. ---")
+    if args.format == 'json' and len(prompts) > 1:
+        print_json([{"prompt": p, **r} for p, r in zip(prompts, responses)])
         return
-    
-    if args.format == 'json':
-        print_json(response)
-    elif args.format == 'table':
-        print_table(response)
-    else: # Default to 'pretty'
-        print_pretty(response)
+
+    for prompt, response in zip(prompts, responses):
+        if len(prompts) > 1:
+            print(f"\n===== {prompt} =====")
+        if not response or not response.get("results"):
+            print("\n--- No results found for your query. ---")
+            continue
+
+        if args.format == 'json':
+            print_json(response)
+        elif args.format == 'table':
+            print_table(response)
+        else: # Default to 'pretty'
+            print_pretty(response)
+
+# Bound format method for histogram rows; the format spec is parsed once.
+_HISTOGRAM_ROW = "{:<30} | {}".format
+
+
+def _format_histogram(key: str, counter: Counter, top_n: int = 25) -> str:
+    """Formats the top `top_n` entries of one histogram as a text block."""
+    maxlen = len(counter)
+    if not maxlen:
+        return ""
+    llen = min(top_n, maxlen)
+    top = "\n".join([_HISTOGRAM_ROW(tag, count) for tag, count in counter.most_common(llen)])
+    return f"\n -- Category {key} {llen} of {maxlen}\n{top}\n-------------------------------\n"
+
 
 def stats_command(args):
     print("Gathering statistics from the database...")
+    from query_utils import get_db_stats
+
     stats = get_db_stats()
     if stats is None:
         return
-    
-    #print (json.dumps(stats, indent=2))
-
-    print("\n--- ChromaDB Collection Stats ---")
-    print(f"Total Documents Indexed: {stats['total_docs']}")
-    print(f"Last Document Update:    {stats['last_update']}")
-    print("---------------------------------")
-    
+
+    # The whole report is built as one string, encoded once and written to
+    # the binary stdout buffer in a single call.
+    report = [
+        "\n--- ChromaDB Collection Stats ---\n",
+        f"Total Documents Indexed: {stats['total_docs']}\n",
+        f"Last Document Update:    {stats['last_update']}\n",
+        "---------------------------------\n",
+    ]
     if stats["histograms"]:
-        
-        for key in stats["histograms"]:
-            #print (f"MARK {key} = {stats['histograms'][key]}")
-            histogram = list(stats["histograms"][key])
-            llen = len(histogram)
-            maxlen = llen
-            if llen > 0:
-                if llen > 25:
-                    llen=25
-
-                print (f"\n -- Category {key} {llen} of {maxlen}")
-                for tag, count in stats["histograms"][key].most_common(llen):
-                    print(f"{tag:<30} | {count}")
-                print("-------------------------------")
+        report.extend(
+            _format_histogram(key, counter)
+            for key, counter in stats["histograms"].items()
+        )
     else:
-        print("\nNo tag information found.")
+        report.append("\nNo tag information found.\n")
+
+    sys.stdout.flush()
+    sys.stdout.buffer.write(
+        "".join(report).encode(sys.stdout.encoding or "utf-8", errors="replace")
+    )
+    sys.stdout.buffer.flush()
 
 
 def server_command(args):
@@ -207,7 +226,56 @@ def server_command(args):
     else:
         print("--- Starting server in Production Mode ---")
         os.environ["APP_MODE"] = "production"
-    uvicorn.run("server:app", host=args.host, port=args.port, reload=True)
+
+    if args.reload:
+        # Development: uvicorn runs in this process with its file watcher.
+        import uvicorn
+
+        uvicorn.run(
+            "server:app",
+            host=args.host,
+            port=args.port,
+            reload=True,
+            loop=args.loop,
+            http="auto",
+        )
+        return
+
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    if os.name != "posix":
+        # On Windows os.execv spawns a new process and exits this one, which
+        # detaches the server from the console (and Ctrl-C), so run in-process.
+        import uvicorn
+
+        uvicorn.run(
+            "server:app",
+            app_dir=app_dir,
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            loop=args.loop,
+            http="auto",
+            log_level="warning",
+            access_log=False,
+        )
+        return
+
+    # Serving: replace this process with uvicorn (uvloop/httptools when
+    # installed) so the CLI's own interpreter state is not kept alive.
+    os.execv(
+        sys.executable,
+        [
+            sys.executable, "-m", "uvicorn", "server:app",
+            "--app-dir", app_dir,
+            "--host", args.host,
+            "--port", str(args.port),
+            "--workers", str(args.workers),
+            "--loop", args.loop,
+            "--http", "auto",
+            "--log-level", "warning",
+            "--no-access-log",
+        ],
+    )
 
 
 def openproduct_command(args):
@@ -217,118 +285,171 @@ def openproduct_command(args):
     open_daz_product(args)
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Visual Asset Browser Data Pipeline CLI"
-    )
-    parser.add_argument(
-        "--product-file",
-        type=str,
-        default="./products.json",
-        help="Path to JSON file containing product data.",
-    )
-    subparsers = parser.add_subparsers(dest="command", required=True)
+# --- Per-command argument registration ---
+# Each command adds its own arguments, so main() can build just the
+# subparser for the command being run.
+
+
+def _add_fetch_args(p):
+    p.add_argument("--prefetch-only", action="store_true", default=False,
+                   help="Only fetch DAZ product metadata, do execute full database construction.")
+
 
-    # Define commands
-    parsers = {
-        "fetch": subparsers.add_parser(
-            "fetch", help="Calls external library to create/update products.json."
-        ),
-        "scrape": subparsers.add_parser(
-            "scrape", help="Scrape products and save to SQLite."
-        ),
-        "enrich": subparsers.add_parser(
-            "enrich", help="Use an LLM to enrich product data."
-        ),
-        "rebuild": subparsers.add_parser(
-            "rebuild", help="Nuke and rebuild the entire ChromaDB from SQLite."
-        ),
-        "load": subparsers.add_parser(
-            "load", help="Load new data from SQLite into ChromaDB."
-        ),
-        "query": subparsers.add_parser(
-            "query", help="Query the ChromaDB vector store."
-        ),
-        "stats": subparsers.add_parser(
-            "stats", help="Display stats about the ChromaDB collection."
-        ),
-        "server": subparsers.add_parser("server", help="Run the FastAPI web server."),
-        "openproduct": subparsers.add_parser(
-            "openproduct",
-            help="Open a naed DAZ product in DAZ Studio's Content Library Pane",
-        ),
-    }
-
-    # Add arguments
-    parsers["scrape"].add_argument(
+def _add_scrape_args(p):
+    p.add_argument(
         "--update",
         action="store_true",
         help="Only scrape products newer than the last checkpoint.",
     )
-    parsers["scrape"].add_argument(
+    p.add_argument(
         "--limit",
         type=int,
         default=None,
         help="Limit the number of URLs to process from the list.",
     )
 
-    parsers["fetch"].add_argument("--prefetch-only", action="store_true", default=False,
-                                  help="Only fetch DAZ product metadata, do execute full database construction.")
 
-    parsers["query"].add_argument("prompt", help="The search prompt.")
-    parsers["query"].add_argument(
+def _add_batch_size_arg(p):
+    p.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="Documents embedded and upserted per batch (default: LOAD_BATCH_SIZE).",
+    )
+
+
+def _add_rebuild_args(p):
+    _add_batch_size_arg(p)
+    p.add_argument(
+        "--yes", action="store_true", help="Skip the confirmation prompt."
+    )
+
+
+def _add_query_args(p):
+    p.add_argument("prompt", nargs="?", help="The search prompt.")
+    p.add_argument(
+        "--prompts-file",
+        type=argparse.FileType("r", encoding="utf-8"),
+        help="File with one search prompt per line, queried as one batch.",
+    )
+    p.add_argument(
         "--tags", nargs="*", help="List of tags to pre-filter results."
     )
-    parsers["query"].add_argument(
+    p.add_argument(
         "--limit", type=int, default=5, help="Max number of results."
     )
-    parsers["query"].add_argument(
+    p.add_argument(
         "--score", type=float, default=1.0, help="Maximum distance (lower is better)."
     )
-    parsers["query"].add_argument(
+    p.add_argument(
         "--sort-by", default="relevance", help="Field to sort by ('relevance', 'name')."
     )
-    parsers["query"].add_argument(
+    p.add_argument(
         "--sort-order", choices=["ascending", "descending"], default="descending"
     )
-    parsers["query"].add_argument("--categories", type=str, default=None)
-    parsers["query"].add_argument(
+    p.add_argument("--categories", type=str, default=None)
+    p.add_argument(
         "--format",
         choices=['pretty', 'json', 'table'],
         default='pretty',
         help="The output format for the results."
     )
-    parsers["query"].add_argument("--artists", nargs='*', help="List of artists to filter by.")
-    parsers["query"].add_argument("--compatible_figures", nargs='*', help="List of figures to filter by.")
+    p.add_argument("--artists", nargs='*', help="List of artists to filter by.")
+    p.add_argument("--compatible_figures", nargs='*', help="List of figures to filter by.")
+
 
-    parsers["server"].add_argument("--host", default="127.0.0.1")
-    parsers["server"].add_argument("--port", type=int, default=8000)
-    parsers["server"].add_argument(
+def _add_server_args(p):
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8000)
+    p.add_argument(
         "--demo", action="store_true", help="Run server in demo mode."
     )
-    
+    p.add_argument(
+        "--reload", action="store_true", help="Restart the server when source files change."
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes. Update task status is kept in memory, so keep 1 when using /update.",
+    )
+    p.add_argument(
+        "--loop",
+        choices=["auto", "uvloop", "asyncio"],
+        default="auto",
+        help="Event loop implementation ('auto' uses uvloop when installed).",
+    )
+
 
-    parsers["openproduct"].add_argument(
+def _add_openproduct_args(p):
+    p.add_argument(
         "--product", help="The name of the product to open in DAZ Studio."
     )
 
-    # Set default functions
-    func_map = {
-        "fetch": fetch_command,
-        "scrape": scrape_command,
-        "enrich": enrich_command,
-        "rebuild": rebuild_command,
-        "load": load_command,
-        "query": query_command,
-        "stats": stats_command,
-        "server": server_command,
-        "openproduct": openproduct_command,
-    }
-    for cmd, sub_parser in parsers.items():
-        sub_parser.set_defaults(func=func_map[cmd])
-
-    args = parser.parse_args()
-    args.func(args)
+
+# command -> (help, handler, argument registrar or None)
+COMMANDS = {
+    "fetch": ("Calls external library to create/update products.json.", fetch_command, _add_fetch_args),
+    "scrape": ("Scrape products and save to SQLite.", scrape_command, _add_scrape_args),
+    "enrich": ("Use an LLM to enrich product data.", enrich_command, None),
+    "rebuild": ("Nuke and rebuild the entire ChromaDB from SQLite.", rebuild_command, _add_rebuild_args),
+    "load": ("Load new data from SQLite into ChromaDB.", load_command, _add_batch_size_arg),
+    "query": ("Query the ChromaDB vector store.", query_command, _add_query_args),
+    "stats": ("Display stats about the ChromaDB collection.", stats_command, None),
+    "server": ("Run the FastAPI web server.", server_command, _add_server_args),
+    "openproduct": (
+        "Open a naed DAZ product in DAZ Studio's Content Library Pane",
+        openproduct_command,
+        _add_openproduct_args,
+    ),
+}
+
+
+def build_parser(only: str | None = None) -> argparse.ArgumentParser:
+    """Builds the CLI parser; with `only`, just that command's subparser."""
+    parser = argparse.ArgumentParser(
+        description="Visual Asset Browser Data Pipeline CLI"
+    )
+    parser.add_argument(
+        "--product-file",
+        type=str,
+        default="./products.json",
+        help="Path to JSON file containing product data.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for cmd, (help_text, _, add_args) in COMMANDS.items():
+        if only is not None and cmd != only:
+            continue
+        sub_parser = subparsers.add_parser(cmd, help=help_text)
+        if add_args is not None:
+            add_args(sub_parser)
+    return parser
+
+
+def main():
+    # Shell tab completion (argcomplete) re-runs the script per keystroke;
+    # it only needs the parser, so answer before anything else is imported.
+    if "_ARGCOMPLETE" in os.environ:
+        try:
+            import argcomplete
+        except ImportError:
+            return
+        argcomplete.autocomplete(build_parser())
+
+    # When the command is the first argument, only its subparser is built;
+    # help output and anything unrecognised get the full parser.
+    argv = sys.argv[1:]
+    only = None
+    if argv and argv[0] in COMMANDS and not {"-h", "--help"} & set(argv):
+        only = argv[0]
+    args = build_parser(only).parse_args(argv)
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    handler = COMMANDS[args.command][1]
+    handler(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,52 @@
+# src/output_formatters.py
+
+import sys
+
+import orjson
+
+
+def print_json(response: dict):
+    """Writes the search response as indented JSON to stdout."""
+    # orjson serializes numpy values natively and returns bytes, which go
+    # straight to the binary stdout buffer.
+    sys.stdout.flush()
+    sys.stdout.buffer.write(
+        orjson.dumps(response, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+    )
+    sys.stdout.buffer.write(b"\n")
+    sys.stdout.buffer.flush()
+
+
+def print_pretty(response: dict):
+    """Writes one readable block per search result."""
+    results = response["results"]
+    lines = [
+        f"\n--- Showing {len(results)} of {response['total_hits']} results ---"
+    ]
+    for rank, result in enumerate(results, start=response.get("offset", 0) + 1):
+        meta = result["metadata"]
+        lines.append(f"\n{rank}. {meta.get('name', result['id'])}")
+        lines.append(f"   SKU:      {meta.get('sku', result['id'])}")
+        lines.append(f"   Artist:   {meta.get('artist', 'N/A')}")
+        lines.append(f"   Category: {meta.get('category', 'N/A')}")
+        lines.append(f"   Distance: {result['distance']:.4f}")
+        if url := meta.get("url"):
+            lines.append(f"   URL:      {url}")
+    sys.stdout.write("\n".join(lines) + "\n")
+
+
+def print_table(response: dict):
+    """Writes the search results as a fixed-width table."""
+    header = f"{'#':>3}  {'Distance':>8}  {'SKU':<10}  {'Name':<50}  {'Category':<20}"
+    lines = [header, "-" * len(header)]
+    for rank, result in enumerate(
+        response["results"], start=response.get("offset", 0) + 1
+    ):
+        meta = result["metadata"]
+        name = str(meta.get("name", result["id"]))[:50]
+        category = str(meta.get("category", ""))[:20]
+        lines.append(
+            f"{rank:>3}  {result['distance']:>8.4f}  {str(meta.get('sku', result['id'])):<10}  {name:<50}  {category:<20}"
+        )
+    lines.append(f"\n{len(response['results'])} of {response['total_hits']} results")
+    sys.stdout.write("\n".join(lines) + "\n")
@@ -1,11 +1,18 @@
-import json
+import heapq
 import os
+import sqlite3
+import threading
 from collections import Counter
+from itertools import chain
 from typing import List, Optional
 
-import chromadb
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 
+from database_utils import (VEC_TABLE, create_vec_table, get_chroma_collection,
+                            metadata_columns, use_vec_backend, vec_blob,
+                            vec_param)
 # Import the centralized embedding utility
 from embedding_utils import generate_embeddings
 
@@ -33,16 +40,10 @@ def build_where_clause(
         if not values:
             return
 
-        # For the 'category' field, which is a single string, we use exact match ($eq)
-        if field_name == "category":
-            conditions = [{field_name: {"$eq": value}} for value in values]
-        # For fields stored as JSON strings of lists, we use substring matching ($contains)
-        else:
-            for value in values:
-                print(
-                    f"+++++ Test field_name: {field_name}, values: {value}, type: {type(value)}"
-                )
-            conditions = [{field_name: {"$contains": value}} for value in values]
+        # 'category' is a single string, so it is matched exactly ($eq); the
+        # other fields are JSON strings of lists, matched by substring ($contains).
+        op = "$eq" if field_name == "category" else "$contains"
+        conditions = [{field_name: {op: value}} for value in values]
 
         if len(conditions) > 1:
             and_conditions.append({"$or": conditions})
@@ -64,6 +65,79 @@ def build_where_clause(
     return {"$and": and_conditions}
 
 
+def _metadata_matches(
+    metadata: dict,
+    tags: Optional[List[str]] = None,
+    artists: Optional[List[str]] = None,
+    categories: Optional[List[str]] = None,
+    compatible_figures: Optional[List[str]] = None,
+) -> bool:
+    """Applies the build_where_clause semantics to a single metadata dict."""
+    if categories and metadata.get("category") not in categories:
+        return False
+    for field_name, values in (
+        ("tags", tags),
+        ("artist", artists),
+        ("compatible_figures", compatible_figures),
+    ):
+        if values and not any(v in (metadata.get(field_name) or "") for v in values):
+            return False
+    return True
+
+
+# One read connection per thread (the API server runs queries on a thread
+# pool), opened on first use and kept for the life of the process.
+_local = threading.local()
+
+
+def _read_connection(with_vec: bool = False) -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(os.getenv("SQLITE_DB_PATH", "products.db"))
+        _local.conn = conn
+        _local.vec_ready = False
+    if with_vec and not _local.vec_ready:
+        create_vec_table(conn)
+        _local.vec_ready = True
+    return conn
+
+
+def _vec_query(query_embedding, n_results: int, **filters) -> dict:
+    """
+    Runs a KNN query against the sqlite-vec table and returns the result in
+    the same shape as ChromaDB's collection.query().
+    """
+    conn = _read_connection(with_vec=True)
+    neighbours = conn.execute(
+        f"SELECT sku, distance FROM {VEC_TABLE} "
+        f"WHERE embedding MATCH {vec_param()} AND k = ? ORDER BY distance",
+        (vec_blob(query_embedding), n_results),
+    ).fetchall()
+    if not neighbours:
+        return {"ids": [], "distances": [], "metadatas": []}
+
+    meta_cols = metadata_columns(conn.cursor())
+    # The SKUs go in as one JSON array parameter, so the statement text is
+    # the same for every query and stays in the connection's statement cache.
+    metadata_by_sku = {
+        row[0]: {k: v for k, v in zip(meta_cols, row) if v is not None}
+        for row in conn.execute(
+            f"SELECT {', '.join(meta_cols)} FROM product "
+            "WHERE sku IN (SELECT value FROM json_each(?))",
+            (orjson.dumps([sku for sku, _ in neighbours]).decode(),),
+        )
+    }
+
+    ids, distances, metadatas = [], [], []
+    for sku, distance in neighbours:
+        metadata = metadata_by_sku.get(sku, {"sku": sku})
+        if _metadata_matches(metadata, **filters):
+            ids.append(sku)
+            distances.append(distance)
+            metadatas.append(metadata)
+    return {"ids": [ids], "distances": [distances], "metadatas": [metadatas]}
+
+
 def search(
     prompt: str,
     tags: Optional[List[str]] = None,
@@ -79,19 +153,59 @@ def search(
     """
     Performs a hybrid search with multiple, faceted metadata filters.
     """
-    load_dotenv()
-    CHROMA_DB_PATH = os.getenv("CHROMA_PATH", "db")
-    COLLECTION_NAME = os.getenv("CHROMA_COLLECTION", "daz_products")
+    return search_batch(
+        [prompt],
+        tags=tags,
+        artists=artists,
+        categories=categories,
+        compatible_figures=compatible_figures,
+        limit=limit,
+        offset=offset,
+        score_threshold=score_threshold,
+        sort_by=sort_by,
+        sort_order=sort_order,
+    )[0]
 
-    client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-    try:
-        collection = client.get_collection(name=COLLECTION_NAME)
-    except ValueError:
-        print(f"Warning: ChromaDB collection '{COLLECTION_NAME}' not found.")
-        return {"total_hits": 0, "limit": limit, "offset": offset, "results": []}
 
-    # --- 1. Generate Query Embedding ---
-    query_embedding = generate_embeddings(prompt, is_query=True)
+def search_batch(
+    prompts: List[str],
+    tags: Optional[List[str]] = None,
+    artists: Optional[List[str]] = None,
+    categories: Optional[List[str]] = None,
+    compatible_figures: Optional[List[str]] = None,
+    limit: int = 10,
+    offset: int = 0,
+    score_threshold: float = 2.0,
+    sort_by: str = "relevance",
+    sort_order: str = "descending",
+) -> list[dict]:
+    """
+    Runs `search` for several prompts at once: the prompts are embedded in
+    one batch and sent to ChromaDB in a single query. Returns one response
+    per prompt, in order.
+    """
+    load_dotenv()
+    empty = {"total_hits": 0, "limit": limit, "offset": offset, "results": []}
+
+    use_vec = use_vec_backend()
+    collection_size = None
+    if not use_vec:
+        # The client is shared by the process; the collection is looked up
+        # by name so a rebuilt collection is used as soon as it is swapped in.
+        _, collection = get_chroma_collection()
+        if collection is None:
+            print(
+                f"Warning: ChromaDB collection "
+                f"'{os.getenv('CHROMA_COLLECTION', 'daz_products')}' not found."
+            )
+            return [dict(empty) for _ in prompts]
+        collection_size = collection.count()
+        if collection_size == 0:
+            print("Warning: ChromaDB collection is empty.")
+            return [dict(empty) for _ in prompts]
+
+    # --- 1. Generate Query Embeddings ---
+    query_embeddings = generate_embeddings(list(prompts), is_query=True)
 
     # --- 2. Build the Combined Metadata Filter ---
     where_filter = build_where_clause(
@@ -103,112 +217,311 @@ def search(
     if where_filter:
         print(f"DEBUG: Applying metadata filter: {where_filter}")
 
-    # Fetch a larger number of results to allow for post-filtering, sorting, and pagination
-    query_limit = (offset + limit) * 5 + 20  # A generous buffer
+    if sort_by == "relevance":
+        # Hits come back nearest first, so the ones under the score threshold
+        # are always at the front; neighbours past the requested page can
+        # never make it into the response.
+        query_limit = offset + limit + 10
+    else:
+        # Fetch a larger number of results to allow for post-filtering, sorting, and pagination
+        query_limit = (offset + limit) * 5 + 20  # A generous buffer
+    if collection_size is not None:
+        query_limit = min(query_limit, collection_size)
+
+    # --- 3. Query the vector store ---
+    if use_vec:
+        # sqlite-vec answers one KNN query per statement.
+        results = {"ids": [], "distances": [], "metadatas": []}
+        for query_embedding in query_embeddings:
+            single = _vec_query(
+                query_embedding,
+                query_limit,
+                tags=tags,
+                artists=artists,
+                categories=categories,
+                compatible_figures=compatible_figures,
+            )
+            for key in results:
+                results[key].append(single[key][0] if single[key] else [])
+    else:
+        results = collection.query(
+            query_embeddings=np.asarray(query_embeddings, dtype=np.float32),
+            n_results=query_limit,
+            where=where_filter,
+            include=["metadatas", "distances"],
+        )
 
-    # --- 3. Query ChromaDB ---
-    results = collection.query(
-        query_embeddings=[query_embedding.tolist()],
-        n_results=query_limit,
-        where=where_filter,
-        include=["metadatas", "distances"],
-    )
+    # --- 4. Post-process Results per Prompt ---
+    responses = []
+    for q in range(len(prompts)):
+        if not results["ids"] or not results["ids"][q]:
+            responses.append(dict(empty))
+            continue
+        responses.append(
+            _build_response(
+                results["ids"][q],
+                results["distances"][q],
+                results["metadatas"][q],
+                limit=limit,
+                offset=offset,
+                score_threshold=score_threshold,
+                sort_by=sort_by,
+                sort_order=sort_order,
+            )
+        )
 
-    # --- 4. Post-process Results (Filtering by Score) ---
-    processed_results = []
-    if results["ids"]:
-        for i in range(len(results["ids"][0])):
-            dist = results["distances"][0][i]
-            if dist <= score_threshold:
-                processed_results.append(
-                    {
-                        "id": results["ids"][0][i],
-                        "distance": dist,
-                        "metadata": results["metadatas"][0][i],
-                    }
-                )
+    return responses
 
-    # --- 5. Sorting Logic ---
+
+def _build_response(
+    ids, distances, metadatas, limit, offset, score_threshold, sort_by, sort_order
+) -> dict:
+    """Filters, sorts and paginates the raw hits of one query."""
+    # --- Filtering by Score ---
+    processed_results = [
+        {"id": doc_id, "distance": dist, "metadata": metadata}
+        for doc_id, dist, metadata in zip(ids, distances, metadatas)
+        if dist <= score_threshold
+    ]
+
+    # --- Sorting Logic ---
     reverse_order = sort_order == "descending"
     if sort_by != "relevance":
-        # Sort by a metadata field, handling potential missing keys gracefully
-        processed_results.sort(
-            key=lambda x: x["metadata"].get(sort_by) or "",  # Fallback for sorting
-            reverse=reverse_order,
+        # Sort by a metadata field, handling potential missing keys gracefully.
+        # Only the first offset + limit results are kept, so a partial heap
+        # selection replaces a full sort.
+        keys = [x["metadata"].get(sort_by) or "" for x in processed_results]
+        select = heapq.nlargest if reverse_order else heapq.nsmallest
+        top = select(
+            offset + limit,
+            range(len(processed_results)),
+            key=keys.__getitem__,
         )
+        total_hits = len(processed_results)
+        processed_results = [processed_results[i] for i in top]
+    else:
+        total_hits = len(processed_results)
     # Note: ChromaDB already returns results sorted by relevance (distance ascending)
 
-    # --- 6. Apply Pagination and Return ---
+    # --- Apply Pagination and Return ---
     paginated_results = processed_results[offset : offset + limit]
 
     return {
-        "total_hits": len(processed_results),
+        "total_hits": total_hits,
         "limit": limit,
         "offset": offset,
         "results": paginated_results,
     }
 
 
-def get_db_stats():
+# JSON list columns of the product table and the histogram each feeds.
+_LIST_HISTOGRAMS = (
+    ("tags", "tags"),
+    ("artists", "artist"),
+    ("compatible_figures", "compatible_figures"),
+)
+_INDEXED_ROWS = "embedding_text IS NOT NULL AND embedding_text != ''"
+
+
+def _sql_stats(conn: sqlite3.Connection) -> tuple[str, dict]:
     """
-    Gathers and returns statistics and histograms for all key filterable fields.
+    Computes the last update and the histograms with GROUP BY queries over
+    the indexed product rows; list columns are expanded with json_each.
     """
-    load_dotenv()
-    CHROMA_DB_PATH = os.getenv("CHROMA_PATH", "db")
-    COLLECTION_NAME = os.getenv("CHROMA_COLLECTION", "daz_products")
+    last_update = conn.execute(
+        f"SELECT max(last_updated) FROM product WHERE {_INDEXED_ROWS}"
+    ).fetchone()[0]
+
+    histograms = {}
+    for key, column in _LIST_HISTOGRAMS:
+        histograms[key] = Counter(
+            dict(
+                conn.execute(
+                    # Malformed or non-list values expand to no rows.
+                    "SELECT j.value, COUNT(*) FROM product, json_each("
+                    f"CASE WHEN json_valid({column}) AND json_type({column}) = 'array' "
+                    f"THEN {column} ELSE '[]' END) AS j "
+                    f"WHERE {_INDEXED_ROWS} GROUP BY j.value"
+                )
+            )
+        )
+    histograms["categories"] = Counter(
+        dict(
+            conn.execute(
+                f"SELECT category, COUNT(*) FROM product "
+                f"WHERE {_INDEXED_ROWS} AND category IS NOT NULL AND category != '' "
+                "GROUP BY category"
+            )
+        )
+    )
+    return last_update or "N/A", histograms
+
 
-    client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+# orjson only produces these exact types, so a set lookup on type() keeps
+# the isinstance() semantics (bool included) at a lower per-item cost.
+_JSON_SCALAR_TYPES = frozenset((str, int, float, bool))
+
+
+def _json_list(value) -> list:
+    """Decodes a JSON list stored as a metadata string; anything else is []."""
+    if not value:
+        return []
     try:
-        collection = client.get_collection(name=COLLECTION_NAME)
-    except ValueError:
-        return None
+        items = orjson.loads(value)
+    except (orjson.JSONDecodeError, TypeError):
+        return []  # Ignore malformed data
+    if not isinstance(items, list):
+        return []
+    return [item for item in items if type(item) in _JSON_SCALAR_TYPES]
 
-    total_docs = collection.count()
-    if total_docs == 0:
-        return {"total_docs": 0, "last_update": "N/A", "histograms": {}}
 
-    all_metadatas = collection.get(include=["metadatas"])["metadatas"]
+_STATS_PAGE_SIZE = 10_000
+
 
-    # Initialize Counters for Histograms
-    tag_counter, artist_counter, figure_counter, category_counter = (
-        Counter(),
-        Counter(),
-        Counter(),
-        Counter(),
+def _chroma_stats(collection) -> tuple[str, dict]:
+    """
+    Fallback for get_db_stats: scans the collection's metadata a page at a
+    time, so only one page of metadata dicts is held in memory.
+    """
+    histograms = {
+        "tags": Counter(),
+        "artists": Counter(),
+        "compatible_figures": Counter(),
+        "categories": Counter(),
+    }
+    list_fields = (
+        ("tags", "tags"),
+        ("artists", "artist"),
+        ("compatible_figures", "compatible_figures"),
+    )
+    # Written by load/rebuild; older collections fall back to the scan.
+    last_update = (collection.metadata or {}).get("last_update")
+    newest = None
+
+    offset = 0
+    while page := collection.get(
+        limit=_STATS_PAGE_SIZE, offset=offset, include=["metadatas"]
+    )["metadatas"]:
+        # Each histogram is updated from one flat iterable per page.
+        for key, field_name in list_fields:
+            histograms[key].update(
+                chain.from_iterable(_json_list(meta.get(field_name)) for meta in page)
+            )
+        histograms["categories"].update(
+            c for meta in page if (c := meta.get("category"))
+        )
+        if last_update is None:
+            dates = [d for meta in page if (d := meta.get("last_updated"))]
+            if newest:
+                dates.append(newest)
+            newest = max(dates, default=None)
+        offset += len(page)
+
+    return last_update or newest or "N/A", histograms
+
+
+# --- Stats cache ---
+# get_db_stats() results are stored in a JSON file next to the products
+# database and reused while the data they were computed from is unchanged.
+
+
+def _stats_cache_path() -> str:
+    return os.getenv(
+        "STATS_CACHE_PATH",
+        f"{os.getenv('SQLITE_DB_PATH', 'products.db')}.stats_cache.json",
     )
 
-    # Find the Last Update Date
-    last_update_dates = [
-        meta.get("last_updated") for meta in all_metadatas if meta.get("last_updated")
+
+def _stats_version(conn: sqlite3.Connection, total_docs: int) -> list:
+    """Cheap fingerprint of the data behind the stats (indexed max lookups)."""
+    return [
+        total_docs,
+        *conn.execute(
+            "SELECT max(last_updated), max(enriched_at) FROM product"
+        ).fetchone(),
     ]
-    last_update = max(last_update_dates) if last_update_dates else "N/A"
-
-    # Iterate and Process All Metadata
-    for meta in all_metadatas:
-        if category := meta.get("category"):
-            category_counter.update([category])
-
-        def parse_and_update_counter(field_name: str, counter: Counter):
-            json_string = meta.get(field_name)
-            if json_string:
-                try:
-                    item_list = json.loads(json_string)
-                    if isinstance(item_list, list):
-                        counter.update(item_list)
-                except (json.JSONDecodeError, TypeError):
-                    pass  # Ignore malformed data
-
-        parse_and_update_counter("tags", tag_counter)
-        parse_and_update_counter("artist", artist_counter)
-        parse_and_update_counter("compatible_figures", figure_counter)
 
-    return {
+
+def _load_cached_stats(version: list) -> dict | None:
+    try:
+        with open(_stats_cache_path(), "rb") as f:
+            cached = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    if cached.get("version") != version:
+        return None
+    stats = cached["stats"]
+    stats["histograms"] = {k: Counter(v) for k, v in stats["histograms"].items()}
+    return stats
+
+
+def _save_cached_stats(version: list, stats: dict):
+    path = _stats_cache_path()
+    try:
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(
+                orjson.dumps(
+                    {"version": version, "stats": stats},
+                    option=orjson.OPT_NON_STR_KEYS,
+                )
+            )
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        print(f"Warning: Could not write stats cache '{path}': {e}")
+
+
+def get_db_stats():
+    """
+    Gathers and returns statistics and histograms for all key filterable fields.
+
+    The histograms are aggregated by SQLite from the product table, which
+    holds the same metadata that is loaded into the vector store. The
+    document count comes from the active backend (ChromaDB or, with
+    USE_VEC=1, the sqlite-vec table). If the product table cannot be read,
+    the ChromaDB metadata is scanned instead.
+    Results are cached until the document count or the newest product
+    timestamps change. Returns None if the collection does not exist.
+    """
+    load_dotenv()
+    if use_vec_backend():
+        # sqlite-vec: the vectors live next to the products; there is no
+        # ChromaDB collection to fall back on.
+        collection = None
+        try:
+            total_docs = _read_connection(with_vec=True).execute(
+                f"SELECT COUNT(*) FROM {VEC_TABLE}"
+            ).fetchone()[0]
+        except (sqlite3.Error, RuntimeError) as e:
+            print(f"Error: Could not read the sqlite-vec table '{VEC_TABLE}': {e}")
+            return None
+    else:
+        _, collection = get_chroma_collection()
+        if collection is None:
+            return None
+        total_docs = collection.count()
+
+    if total_docs == 0:
+        return {"total_docs": 0, "last_update": "N/A", "histograms": {}}
+
+    try:
+        conn = _read_connection()
+        version = _stats_version(conn, total_docs)
+        if (stats := _load_cached_stats(version)) is not None:
+            return stats
+        last_update, histograms = _sql_stats(conn)
+    except sqlite3.Error as e:
+        if collection is None:
+            print(f"Error: Could not aggregate stats in SQLite: {e}")
+            return None
+        print(f"Warning: Could not aggregate stats in SQLite ({e}); scanning ChromaDB.")
+        last_update, histograms = _chroma_stats(collection)
+        version = None
+
+    stats = {
         "total_docs": total_docs,
         "last_update": last_update,
-        "histograms": {
-            "tags": tag_counter,
-            "artists": artist_counter,
-            "compatible_figures": figure_counter,
-            "categories": category_counter,
-        },
+        "histograms": histograms,
     }
+    if version is not None:
+        _save_cached_stats(version, stats)
+    return stats
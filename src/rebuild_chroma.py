@@ -2,97 +2,163 @@
 
 import os
 import sqlite3
+import time
+from functools import partial
 
-import chromadb
 from dotenv import load_dotenv
 
-# Import the new embedding utility
-from embedding_utils import generate_embeddings
+from database_utils import (VEC_TABLE, chroma_collection_metadata,
+                            create_vec_table, embed_and_write, get_chroma_client,
+                            load_sqlite_vec, metadata_columns, swap_vec_table,
+                            upsert_batch, upsert_vec_batch, use_vec_backend)
 
 # --- Configuration ---
 
 
-def main():
+def main(batch_size: int | None = None):
     """
     Reads all products from an SQLite database, generates new embeddings,
-    and completely rebuilds the ChromaDB collection.
+    and completely rebuilds the ChromaDB collection (or, with USE_VEC=1, the
+    sqlite-vec table) in batches of `batch_size` (defaults to LOAD_BATCH_SIZE).
+
+    The new collection is built under a temporary name and swapped in when
+    it is complete, so the current collection stays queryable during the
+    rebuild and is left untouched if the rebuild fails.
     """
     # --- 1. Load Configuration and Initialize Clients ---
     load_dotenv()
-    CHROMA_DB_PATH = os.getenv("CHROMA_PATH", "db")
     COLLECTION_NAME = os.getenv("CHROMA_COLLECTION", "daz_products")
     SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "products.db")
+    batch_size = batch_size or int(os.getenv("LOAD_BATCH_SIZE", "1000"))
 
-    client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-
-    print(f"Resetting and preparing ChromaDB collection: '{COLLECTION_NAME}'")
-    # Delete the old collection to ensure a clean rebuild
-    try:
-        client.delete_collection(name=COLLECTION_NAME)
-    except Exception as e:
-        print(
-            f"WARNING: Collection {COLLECTION_NAME} not found, creating new one: {str(e)}"
-        )
-    collection = client.get_or_create_collection(
-        name=COLLECTION_NAME,
-        metadata={"hnsw:space": "cosine"},  # Example for 768-dim embeddings
-    )
-
-    # --- 2. Read All Products from SQLite ---
+    # --- 2. Open the Product Query on SQLite ---
     print(f"Connecting to SQLite database: '{SQLITE_DB_PATH}'")
+    where = "WHERE embedding_text IS NOT NULL AND embedding_text != ''"
     try:
         conn = sqlite3.connect(SQLITE_DB_PATH)
-        conn.row_factory = sqlite3.Row
+        if use_vec_backend():
+            # sqlite-vec cannot be loaded while the row query is active.
+            load_sqlite_vec(conn)
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM product")
-        all_products = cursor.fetchall()
-        conn.close()
-        print(f"Found {len(all_products)} products in the SQLite database.")
+        total, last_update = cursor.execute(
+            f"SELECT COUNT(*), max(last_updated) FROM product {where}"
+        ).fetchone()
+        print(f"Found {total} products with embedding_text in the SQLite database.")
+        # Project only the stored columns and keep the default tuple rows;
+        # rows are streamed per batch and each is turned into its id,
+        # document and metadata dict in a single pass.
+        meta_cols = metadata_columns(cursor)
+        cursor.execute(
+            f"SELECT sku, embedding_text, {', '.join(meta_cols)} FROM product {where}"
+        )
     except sqlite3.OperationalError as e:
         print(f"Error reading from SQLite: {e}")
         return
 
-    # --- 3. Prepare Data for Batch Processing ---
-    valid_products = [dict(row) for row in all_products if row["embedding_text"]]
-    texts_to_embed = [p["embedding_text"] for p in valid_products]
-
-    if not valid_products:
+    if not total:
         print("No products with embedding_text found. Aborting.")
+        conn.close()
+        return
+
+    if use_vec_backend():
+        _rebuild_vec(conn, cursor, meta_cols, batch_size)
         return
 
-    # --- 4. Generate All Embeddings in a Single Batch ---
-    print(f"Generating embeddings for {len(texts_to_embed)} documents...")
-    # 'is_query=False' tells the utility these are documents for storage
-    embedding_list = generate_embeddings(texts_to_embed, is_query=False).tolist()
-    print("Embeddings generated successfully.")
-
-    # --- 5. Prepare Metadata and IDs ---
-    ids = [str(p["sku"]) for p in valid_products]
-    documents = [p["embedding_text"] for p in valid_products]
-
-    metadatas = []
-    for item in valid_products:
-        clean_meta = {}
-        for key, value in item.items():
-            # Ensure all metadata values are simple types for ChromaDB
-            if value is not None and isinstance(value, (str, int, float, bool)):
-                clean_meta[key] = value
-        metadatas.append(clean_meta)
-
-    # --- 6. Upsert the Batch into ChromaDB ---
-    # Note: ChromaDB batches automatically, but we do it here for clarity.
-    # For very large datasets (>10k), you might want to loop in smaller batches.
+    # The process-wide client, so a server that runs the rebuild does not
+    # open a second client on the same path.
+    client = get_chroma_client()
+    shadow_name = f"{COLLECTION_NAME}_rebuild_{int(time.time())}"
+    print(f"Building new ChromaDB collection: '{shadow_name}'")
+    # A fresh collection also picks up any changed HNSW settings.
+    metadata = chroma_collection_metadata()
+    if last_update:
+        metadata["last_update"] = last_update
+    collection = client.create_collection(name=shadow_name, metadata=metadata)
+
+    # --- 3. Embed and Upsert in Batches ---
+    # Same pipeline as the incremental load: batch N+1 is embedded while
+    # batch N is upserted. Any failure abandons the new collection.
     try:
-        collection.upsert(
-            embeddings=embedding_list, documents=documents, metadatas=metadatas, ids=ids
-        )
-        print(f"\n--- Success! ---")
-        print(
-            f"Upserted {len(ids)} documents into ChromaDB collection '{COLLECTION_NAME}'."
+        upserted, _ = embed_and_write(
+            cursor,
+            meta_cols,
+            batch_size,
+            partial(upsert_batch, collection),
+            stop_on_error=True,
         )
     except Exception as e:
         print(f"An error occurred while publishing to ChromaDB: {e}")
+        print(f"Keeping the existing collection '{COLLECTION_NAME}'.")
+        client.delete_collection(name=shadow_name)
+        return
+    finally:
+        conn.close()
 
+    # --- 4. Swap the New Collection In ---
+    _swap_collections(client, COLLECTION_NAME, collection)
+    print(f"\n--- Success! ---")
+    print(
+        f"Upserted {upserted} documents into ChromaDB collection '{COLLECTION_NAME}'."
+    )
+
+
+def _rebuild_vec(conn, cursor, meta_cols: list[str], batch_size: int):
+    """
+    sqlite-vec variant of the rebuild: the vectors are written to a new vec0
+    table, which replaces the current one in a single transaction. The new
+    table is created with the current VEC_INT8 and EMBEDDING_MODEL_DIMS.
+    """
+    shadow_name = f"{VEC_TABLE}_rebuild"
+    print(f"Building new sqlite-vec table: '{shadow_name}'")
+    try:
+        # Left over if an earlier rebuild was interrupted.
+        conn.execute(f"DROP TABLE IF EXISTS {shadow_name}")
+        create_vec_table(conn, table=shadow_name)
+        conn.commit()
+        upserted, _ = embed_and_write(
+            cursor,
+            meta_cols,
+            batch_size,
+            partial(upsert_vec_batch, conn, table=shadow_name),
+            stop_on_error=True,
+        )
+        swap_vec_table(conn, shadow_name)
+    except Exception as e:
+        print(f"An error occurred while building the sqlite-vec table: {e}")
+        print(f"Keeping the existing table '{VEC_TABLE}'.")
+        # The row query may still be active, which would block the DROP.
+        cursor.close()
+        conn.rollback()
+        conn.execute(f"DROP TABLE IF EXISTS {shadow_name}")
+        conn.commit()
+        return
+    finally:
+        conn.close()
+
+    print(f"\n--- Success! ---")
+    print(f"Wrote {upserted} vectors to sqlite-vec table '{VEC_TABLE}'.")
+
+
+def _swap_collections(client, active_name: str, shadow):
+    """
+    Renames the `shadow` collection to `active_name`. The current collection
+    is first moved aside and is deleted only after the rename succeeded.
+    """
+    old_name = f"{active_name}_old_{int(time.time())}"
+    try:
+        old = client.get_collection(name=active_name)
+    except Exception:
+        old = None  # First build: nothing to replace.
+    if old is not None:
+        old.modify(name=old_name)
+    try:
+        shadow.modify(name=active_name)
+    except Exception:
+        if old is not None:
+            old.modify(name=active_name)
+        raise
+    if old is not None:
+        client.delete_collection(name=old_name)
 
 if __name__ == "__main__":
     main()
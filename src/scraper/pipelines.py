@@ -1,16 +1,30 @@
 # asset_scraper/pipelines.py
 
-import json
 import re
 import sqlite3
 from datetime import datetime, timezone
 
+import orjson
+
+# Compiled once; process_item runs for every scraped product.
+_NON_PRICE_RE = re.compile(r"[^\d.]")
+_NON_DIGIT_RE = re.compile(r"\D")
+_LIST_FIELDS = (
+    "artist",
+    "tags",
+    "formats",
+    "required_products",
+    "compatible_figures",
+    "compatible_software",
+)
+
 
 def clean_list_field(items):
     """Helper function to strip whitespace from a list of strings."""
     if not items:
         return []
-    return [item.strip() for item in items if item.strip()]
+    # Each item is stripped once; empty results are dropped.
+    return [stripped for item in items if (stripped := item.strip())]
 
 
 class AssetProcessingPipeline:
@@ -28,22 +42,15 @@ class AssetProcessingPipeline:
 
         # --- 1. Data Cleaning ---
         if item.get("price"):
-            item["price"] = re.sub(r"[^\d.]", "", item["price"])
+            item["price"] = _NON_PRICE_RE.sub("", item["price"])
         if item.get("poly_count"):
             poly_str = item.get("poly_count", "")
-            item["poly_count"] = re.sub(r"\D", "", poly_str)
+            item["poly_count"] = _NON_DIGIT_RE.sub("", poly_str)
         if item.get("sku"):
             item["sku"] = item["sku"].strip()
 
         # Clean all list-based fields
-        for field in [
-            "artist",
-            "tags",
-            "formats",
-            "required_products",
-            "compatible_figures",
-            "compatible_software",
-        ]:
+        for field in _LIST_FIELDS:
             if item.get(field):
                 item[field] = clean_list_field(item[field])
 
@@ -87,17 +94,24 @@ class SQLitePipeline:
     """
     This pipeline takes the processed item and saves it to an SQLite database.
     It uses INSERT OR REPLACE to handle updates to existing products.
+    Items are buffered and written `batch_size` at a time, one transaction
+    per batch; the remainder is written when the spider closes.
     """
 
-    def __init__(self, sqlite_db, sqlite_table):
+    def __init__(self, sqlite_db, sqlite_table, batch_size=500):
         self.sqlite_db = sqlite_db
         self.sqlite_table = sqlite_table
+        self.batch_size = batch_size
+        # Items with the same set of columns share one INSERT statement.
+        self.pending = {}
+        self.pending_count = 0
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(
             sqlite_db=crawler.settings.get("SQLITE_DB", "products.db"),
             sqlite_table=crawler.settings.get("SQLITE_TABLE", "product"),
+            batch_size=crawler.settings.getint("SQLITE_BATCH_SIZE", 500),
         )
 
     def open_spider(self, spider):
@@ -137,27 +151,53 @@ class SQLitePipeline:
         self.conn.commit()
 
     def close_spider(self, spider):
+        self._flush(spider)
         self.conn.close()
 
+    def _insert_sql(self, columns):
+        placeholders = ", ".join(["?"] * len(columns))
+        return (
+            f"INSERT OR REPLACE INTO {self.sqlite_table} "
+            f"({', '.join(columns)}) VALUES ({placeholders})"
+        )
+
+    def _flush(self, spider):
+        """Writes the buffered items in a single transaction."""
+        if not self.pending:
+            return
+        pending, count = self.pending, self.pending_count
+        self.pending, self.pending_count = {}, 0
+        try:
+            with self.conn:
+                for columns, rows in pending.items():
+                    self.conn.executemany(self._insert_sql(columns), rows)
+            spider.logger.info(f"Saved {count} items to SQLite.")
+        except Exception as e:
+            # Retry row by row so one bad item does not lose the whole batch.
+            spider.logger.warning(f"Batch insert failed ({e}); saving items one by one.")
+            for columns, rows in pending.items():
+                sql = self._insert_sql(columns)
+                for row in rows:
+                    try:
+                        with self.conn:
+                            self.conn.execute(sql, row)
+                    except Exception as e:
+                        sku = dict(zip(columns, row)).get("sku")
+                        spider.logger.error(f"Failed to save item {sku} to SQLite: {e}")
+
     def process_item(self, item, spider):
         # Convert any list fields to JSON strings for database storage
         for key, value in item.items():
             if isinstance(value, list):
-                item[key] = json.dumps(value)
+                item[key] = orjson.dumps(value).decode()
 
         # Add the update timestamp
         item["last_updated"] = datetime.now(timezone.utc).isoformat()
 
-        # Prepare columns and placeholders for a robust upsert operation
-        columns = ", ".join(item.keys())
-        placeholders = ", ".join(["?"] * len(item))
-        sql = f"INSERT OR REPLACE INTO {self.sqlite_table} ({columns}) VALUES ({placeholders})"
-
-        try:
-            self.cursor.execute(sql, list(item.values()))
-            self.conn.commit()
-            spider.logger.info(f"Successfully saved item {item.get('sku')} to SQLite.")
-        except Exception as e:
-            spider.logger.error(f"Failed to save item {item.get('sku')} to SQLite: {e}")
+        # Queue the row under its column set for the next batched upsert
+        self.pending.setdefault(tuple(item.keys()), []).append(tuple(item.values()))
+        self.pending_count += 1
+        if self.pending_count >= self.batch_size:
+            self._flush(spider)
 
         return item
@@ -2,6 +2,8 @@
 
 # Scrapy settings for asset_scraper project
 
+import os
+
 BOT_NAME = "asset_scraper"
 
 # CHANGE THESE TWO LINES
@@ -16,9 +18,19 @@ ROBOTSTXT_OBEY = True
 # Set a custom User-Agent to identify your bot
 USER_AGENT = "VisualAssetBrowserBot/1.0 (For personal content indexing; https://your-project-url.com)"
 
-# Configure a delay for requests for the same website (e.g., 2 seconds)
-DOWNLOAD_DELAY = 2
-CONCURRENT_REQUESTS_PER_DOMAIN = 8
+# Requests in flight and the delay between requests to the store. The
+# defaults are the polite 8 concurrent requests with a 2 second delay; set
+# SCRAPER_CONCURRENCY / SCRAPER_DOWNLOAD_DELAY to crawl faster. AutoThrottle
+# never goes below DOWNLOAD_DELAY and backs off when the server slows down.
+SCRAPER_CONCURRENCY = int(os.getenv("SCRAPER_CONCURRENCY", "8"))
+CONCURRENT_REQUESTS = SCRAPER_CONCURRENCY
+CONCURRENT_REQUESTS_PER_DOMAIN = SCRAPER_CONCURRENCY
+DOWNLOAD_DELAY = float(os.getenv("SCRAPER_DOWNLOAD_DELAY", "2"))
+
+AUTOTHROTTLE_ENABLED = True
+AUTOTHROTTLE_START_DELAY = DOWNLOAD_DELAY
+AUTOTHROTTLE_MAX_DELAY = 10
+AUTOTHROTTLE_TARGET_CONCURRENCY = max(1.0, SCRAPER_CONCURRENCY / 2)
 
 
 # --- Playwright Settings for JavaScript Rendering ---
@@ -31,6 +43,17 @@ DOWNLOAD_HANDLERS = {
 # Set the required Twisted reactor for asyncio compatibility.
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 
+# Allow as many browser pages as concurrent requests, and skip downloading
+# resources the parser never reads.
+PLAYWRIGHT_MAX_PAGES_PER_CONTEXT = SCRAPER_CONCURRENCY
+
+
+def should_abort_request(request):
+    return request.resource_type in ("image", "media", "font")
+
+
+PLAYWRIGHT_ABORT_REQUEST = should_abort_request
+
 
 # --- Item Pipeline Configuration ---
 # The order is important: process the item first, then save it to the database.
@@ -44,6 +67,8 @@ ITEM_PIPELINES = {
 # --- Custom Settings for Pipelines ---
 SQLITE_DB = "products.db"
 SQLITE_TABLE = "product"
+# Scraped items written per SQLite transaction
+SQLITE_BATCH_SIZE = int(os.getenv("SQLITE_BATCH_SIZE", "500"))
 
 
 # --- Standard Scrapy Settings ---
@@ -7,12 +7,21 @@ class BaseAssetSpider(scrapy.Spider):
     store_name = "Unknown"
     # Selectors are defined in subclasses
 
+    # Item fields set by parse_product itself rather than an extract_* method
+    _PRESET_FIELDS = frozenset({"url", "store", "sku", "mature", "category"})
+
     def __init__(self, products=None, *args, **kwargs):
         super(BaseAssetSpider, self).__init__(*args, **kwargs)
         # The list of {'url': '...', 'sku': '...'} is now an attribute of the spider
         self.products_to_scrape = products
         # We no longer use the 'start_urls' attribute from the CrawlerProcess
         self.start_urls = []
+        # Resolve the extract_<field> methods once instead of per response.
+        self._extractors = [
+            (field, getattr(self, f"extract_{field}"))
+            for field in AssetItem.fields
+            if field not in self._PRESET_FIELDS and hasattr(self, f"extract_{field}")
+        ]
 
     async def start(self):
         for req in self.start_requests():
@@ -71,11 +80,8 @@ class BaseAssetSpider(scrapy.Spider):
         item["url"] = response.url
         item["store"] = self.store_name
 
-        for field in item.fields:
-            if field not in ["url", "store", "sku", "mature", "category"] and hasattr(
-                self, f"extract_{field}"
-            ):
-                item[field] = getattr(self, f"extract_{field}")(response)
+        for field, extract in self._extractors:
+            item[field] = extract(response)
 
         # Get the list of figures that was just scraped (it might be an empty list)
         scraped_figures = item.get("compatible_figures", [])
@@ -1,20 +1,44 @@
+import asyncio
 import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from functools import partial
 from typing import List, Optional
 
 from fastapi import BackgroundTasks, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 
-from api_tasks import run_update_flow
+from api_tasks import TaskStatus, run_update_flow
 from demo_data import get_demo_search_results as search_mock
 from demo_data import get_demo_stats as get_demo_stats_mock
 from open_daz_product import main as open_daz_product
 from query_utils import get_db_stats, search
 
 APP_MODE = os.getenv("APP_MODE", "production")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Blocking work (embedding, vector search, DAZ Studio launch) runs on
+    # this pool so the event loop stays free to accept requests.
+    app.state.pool = ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2)
+    yield
+    app.state.pool.shutdown(wait=False)
+
+
+async def run_blocking(func, /, *args, **kwargs):
+    """Runs `func` on the app's thread pool and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.pool, partial(func, *args, **kwargs))
+
+
 app = FastAPI(
-    title=f"Visual Asset Browser API ({APP_MODE.upper()} MODE)", version="1.0.0"
+    title=f"Visual Asset Browser API ({APP_MODE.upper()} MODE)",
+    version="1.0.0",
+    lifespan=lifespan,
 )
 app.add_middleware(
     CORSMiddleware,
@@ -24,7 +48,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-update_tasks = {}
+update_tasks: dict[str, TaskStatus] = {}
 
 
 class QueryRequest(BaseModel):
@@ -46,11 +70,7 @@ def start_update(background_tasks: BackgroundTasks):
             status_code=403, detail="Update functionality is disabled in demo mode."
         )
     task_id = str(uuid.uuid4())
-    update_tasks[task_id] = {
-        "status": "pending",
-        "stage": "start",
-        "progress": "Task has been queued.",
-    }
+    update_tasks[task_id] = TaskStatus()
     background_tasks.add_task(run_update_flow, update_tasks[task_id])
     return {"message": "Update process started.", "task_id": task_id}
 
@@ -59,28 +79,28 @@ def get_update_status(task_id: str):
     task = update_tasks.get(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
-    return task
+    return asdict(task)
 
 @app.post("/api/v1/query")
-def run_query(request: QueryRequest):
+async def run_query(request: QueryRequest):
     print(f"Received query request: {request}")
     print(f"model dump: {request.model_dump()}")
-    return (
-        search_mock(**request.model_dump())
-        if APP_MODE == "demo"
-        else search(**request.model_dump())
-    )
+    if APP_MODE == "demo":
+        return search_mock(**request.model_dump())
+    return await run_blocking(search, **request.model_dump())
 
 
 @app.get("/api/v1/browseproduct/{product_id}")
-def browse_product(product_id: str):
+async def browse_product(product_id: str):
     if APP_MODE == "demo":
         return
-    open_daz_product(args=type("obj", (object,), {"product": product_id}))
+    await run_blocking(
+        open_daz_product, args=type("obj", (object,), {"product": product_id})
+    )
 
 
 @app.get("/api/v1/info")
-def get_info():
+async def get_info():
     """
     Runs the stats command and returns the result as a JSON document,
     including histograms for filterable fields.
@@ -92,7 +112,7 @@ def get_info():
         return get_demo_stats_mock()
 
     # --- PRODUCTION MODE ---
-    stats = get_db_stats()
+    stats = await run_blocking(get_db_stats)
     if stats is None:
         raise HTTPException(
             status_code=404, detail="Database collection not found or empty."
@@ -1,3 +1,4 @@
+import importlib.util
 import os
 import pathlib
 import subprocess
@@ -5,28 +6,51 @@ import sys
 import datetime
 from datetime import timedelta, timezone
 from datetime import datetime
-import requests
 
 
 CHECKPOINT_FILE = ".checkpoint"
 
 
 def get_checkpoint():
-    rv=None
-    if os.path.exists(CHECKPOINT_FILE):
+    try:
         with open(CHECKPOINT_FILE, "r") as f:
             rv = f.read().strip()
-    else:
+    except FileNotFoundError:
         rv = (datetime.now(timezone.utc) - timedelta(days=365 * 10)).isoformat()
 
     print (f'Checkpoint read: {rv}')
     return rv
 
 
-def set_checkpoint():
-    with open(CHECKPOINT_FILE, "w") as f:
-        f.write(datetime.now(timezone.utc).isoformat())
-    print(f"Checkpoint updated to {get_checkpoint()}")
+def set_checkpoint(checkpoint: str | None = None):
+    # Callers that loaded data pass the newest timestamp they loaded; the
+    # wall clock is only the fallback.
+    if checkpoint is None:
+        checkpoint = datetime.now(timezone.utc).isoformat()
+    # Write to a temp file and rename over the old checkpoint so a crash
+    # mid-write can never leave a truncated checkpoint behind.
+    tmp_file = f"{CHECKPOINT_FILE}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(checkpoint)
+    os.replace(tmp_file, CHECKPOINT_FILE)
+    print(f"Checkpoint updated to {checkpoint}")
+
+
+def pick_attn_implementation() -> str | None:
+    """
+    Returns the attention kernel to request from transformers: the
+    LLM_ATTN_IMPLEMENTATION override, else FlashAttention-2 when it is
+    installed and a GPU is present, else None so transformers picks its
+    default for the architecture (SDPA, or eager where SDPA is unsupported).
+    """
+    configured = os.getenv("LLM_ATTN_IMPLEMENTATION")
+    if configured:
+        return configured
+    import torch
+
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn"):
+        return "flash_attention_2"
+    return None
 
 
 def run_daz_script(script_name: str, script_args:list) -> bool:
@@ -93,54 +117,3 @@ def run_daz_script(script_name: str, script_args:list) -> bool:
     except Exception as e:
         print(f"An unexpected error occurred while executing the DAZ script: {e}", file=sys.stderr)
         return False
-
-def fetch_json_from_url(url: str, timeout: int = 10) -> dict | None:
-    """
-    Fetches content from a URL, parses it as JSON, and returns it.
-
-    This function includes robust error handling for common network and data issues.
-
-    Args:
-        url (str): The URL to fetch data from.
-        timeout (int): The number of seconds to wait for a server response.
-
-    Returns:
-        dict | None: A dictionary containing the parsed JSON data if successful,
-                      otherwise None.
-    """
-    print(f"Fetching JSON from: {url}")
-    try:
-        # 1. Make the HTTP GET request with a timeout.
-        response = requests.get(url, timeout=timeout)
-
-        # 2. Check for HTTP errors (e.g., 404 Not Found, 500 Server Error).
-        # This will raise an HTTPError if the status code is 4xx or 5xx.
-        response.raise_for_status()
-
-        # 3. Try to parse the response content as JSON.
-        # This will raise a JSONDecodeError if the content is not valid JSON.
-        return response.json()
-
-    except requests.exceptions.HTTPError as http_err:
-        # Handle specific HTTP status code errors (4xx/5xx).
-        print(f"Error: HTTP Error occurred: {http_err}", file=sys.stderr)
-        print(f"Status Code: {http_err.response.status_code}", file=sys.stderr)
-        return None
-
-    except requests.exceptions.JSONDecodeError:
-        # Handle cases where the response is not valid JSON (e.g., it's HTML).
-        print(
-            f"Error: Failed to decode JSON. The content from the URL is not valid JSON.",
-            file=sys.stderr,
-        )
-        return None
-
-    except requests.exceptions.RequestException as req_err:
-        # Handle broader network issues (e.g., DNS failure, connection refused, timeout).
-        print(f"Error: A network error occurred: {req_err}", file=sys.stderr)
-        return None
-
-    except Exception as e:
-        # A final catch-all for any other unexpected errors.
-        print(f"An unexpected error occurred: {e}", file=sys.stderr)
-        return None